@@ -1,4 +1,5 @@
 import logging
+from typing import Optional
 
 from langchain_core.prompts import ChatPromptTemplate, SystemMessagePromptTemplate, MessagesPlaceholder
 from langchain_core.runnables import RunnablePassthrough
@@ -12,13 +13,18 @@ from langchain.agents.output_parsers.openai_tools import OpenAIToolsAgentOutputP
 from langchain_core.vectorstores import VectorStore
 from langchain.sql_database import SQLDatabase
 
+from db.bm25_index import BM25Index
+from db.embedding_matrix import EmbeddingMatrix
+
+from agent.executor import ParallelAgentExecutor
 from agent.model import model, tool_model
 from agent.tools import create_agent_tools
 from agent.parser import handle_client_tool_calls
 
 logger = logging.getLogger(__name__)
 
-def create_agent(db: VectorStore, sqlite_db: SQLDatabase) -> AgentExecutor:
+def create_agent(db: VectorStore, sqlite_db: SQLDatabase, lexical_index: BM25Index,
+                 chunk_store: Optional[VectorStore] = None, embedding_matrix: Optional[EmbeddingMatrix] = None) -> AgentExecutor:
     system_template = """
     <Role>
         You are a medical expert and medical data analyist embedded within a data exploration app using patient journey data.
@@ -81,7 +87,7 @@ def create_agent(db: VectorStore, sqlite_db: SQLDatabase) -> AgentExecutor:
         ]
     )
 
-    tools = create_agent_tools(tool_model, db, sqlite_db)
+    tools = create_agent_tools(tool_model, db, sqlite_db, lexical_index, chunk_store, embedding_matrix)
 
     llm_with_tools = model.bind(tools=[convert_to_openai_tool(tool) for tool in tools])
 
@@ -102,6 +108,7 @@ def create_agent(db: VectorStore, sqlite_db: SQLDatabase) -> AgentExecutor:
             | handle_client_tool_calls
     )
 
-    agent_executor = AgentExecutor(tools=tools, agent=agent, verbose=True, handle_parsing_errors=True)
+    # Independent tool calls of one step (e.g. a similarity search and a SQL query) run concurrently
+    agent_executor = ParallelAgentExecutor(tools=tools, agent=agent, verbose=True, handle_parsing_errors=True)
 
     return agent_executor
\ No newline at end of file
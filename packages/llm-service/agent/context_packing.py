@@ -0,0 +1,96 @@
+import logging
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+import tiktoken
+from langchain_core.documents import Document
+
+from db.chroma_db import PID_METADATA_FIELD_NAME
+
+# Packs retrieved patient journeys into a token budget, so tool results never overflow the model's context window:
+# Journeys are taken in the order of their relevance, the first journey that doesn't fit anymore is truncated and
+# the remaining journeys are omitted (their PIDs are reported, so they can be retrieved specifically).
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TOOL_CONTEXT_TOKEN_BUDGET = 8000
+
+# Used for models unknown to tiktoken (e.g. Azure deployment names)
+FALLBACK_ENCODING_NAME = 'cl100k_base'
+
+# A journey is only truncated if at least this many of its tokens fit into the remaining budget
+MIN_TRUNCATED_JOURNEY_TOKENS = 200
+
+TRUNCATION_MARKER = ' … [truncated]'
+
+MAX_NR_OF_CACHED_TOKEN_COUNTS = 4096
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model_name: Optional[str]) -> tiktoken.Encoding:
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except (KeyError, TypeError):
+        return tiktoken.get_encoding(FALLBACK_ENCODING_NAME)
+
+
+@lru_cache(maxsize=MAX_NR_OF_CACHED_TOKEN_COUNTS)
+def count_tokens(text: str, model_name: Optional[str]) -> int:
+    # Journeys are retrieved again and again, so their token counts are cached
+    return len(get_encoding(model_name).encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text: str, max_tokens: int, model_name: Optional[str]) -> str:
+    encoding = get_encoding(model_name)
+    return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens]) + TRUNCATION_MARKER
+
+
+def pack_texts(texts: List[str], token_budget: int, model_name: Optional[str]) -> Tuple[List[str], int]:
+    """
+    Packs the texts (ordered by relevance) into the token budget.
+    Returns the packed texts – the last one possibly truncated – and the number of omitted texts.
+    """
+    packed_texts = []
+    remaining_tokens = token_budget
+    for text in texts:
+        token_count = count_tokens(text, model_name)
+        if token_count <= remaining_tokens:
+            packed_texts.append(text)
+            remaining_tokens -= token_count
+            continue
+        if remaining_tokens >= MIN_TRUNCATED_JOURNEY_TOKENS:
+            packed_texts.append(truncate_to_tokens(text, remaining_tokens, model_name))
+        break
+
+    omitted_count = len(texts) - len(packed_texts)
+    if omitted_count or (packed_texts and packed_texts[-1].endswith(TRUNCATION_MARKER)):
+        logger.info(f"Packed {len(texts)} patient journeys into {token_budget} tokens: "
+                    f"{len(packed_texts)} included, {omitted_count} omitted")
+    return packed_texts, omitted_count
+
+
+def create_omission_note(omitted_pids: List[str]) -> str:
+    return (f"{len(omitted_pids)} less relevant patient journeys were omitted to fit into the context window "
+            f"(PIDs: {', '.join(omitted_pids)}). Retrieve them specifically, if they are needed.")
+
+
+def pack_documents(docs: List[Document], token_budget: int, model_name: Optional[str]) -> List[Document]:
+    packed_texts, omitted_count = pack_texts([doc.page_content for doc in docs], token_budget, model_name)
+    packed_docs = [Document(page_content=text, metadata=doc.metadata) for doc, text in zip(docs, packed_texts)]
+    if omitted_count:
+        # Several chunks of the same journey may be omitted
+        omitted_pids = list(dict.fromkeys(str(doc.metadata.get(PID_METADATA_FIELD_NAME)) for doc in docs[len(packed_texts):]))
+        packed_docs.append(Document(page_content=create_omission_note(omitted_pids)))
+    return packed_docs
+
+
+def pack_get_result(result: dict, pids: List[str], token_budget: int, model_name: Optional[str]) -> dict:
+    """Packs the result of a vector store get (ids & documents), ranked by the order of the requested PIDs."""
+    rank = {pid: i for i, pid in enumerate(pids)}
+    order = sorted(range(len(result['ids'])), key=lambda i: rank.get(result['ids'][i], len(rank)))
+    ids = [result['ids'][i] for i in order]
+    packed_texts, omitted_count = pack_texts([result['documents'][i] for i in order], token_budget, model_name)
+    packed_result = {'ids': ids[:len(packed_texts)], 'documents': packed_texts}
+    if omitted_count:
+        packed_result['note'] = create_omission_note(ids[len(packed_texts):])
+    return packed_result
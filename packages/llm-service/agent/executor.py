@@ -0,0 +1,58 @@
+import asyncio
+import contextvars
+import logging
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Iterator, Union
+
+from langchain.agents import AgentExecutor
+from langchain_core.agents import AgentAction, AgentFinish, AgentStep
+
+from utils.get_env import get_env
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_CONCURRENT_TOOL_CALLS = 4
+
+# Shared by all agent executors, so the number of concurrently running tools stays bounded
+tool_call_pool = ThreadPoolExecutor(
+    max_workers=int(get_env('MAX_CONCURRENT_TOOL_CALLS') or DEFAULT_MAX_CONCURRENT_TOOL_CALLS),
+    thread_name_prefix='tool-call',
+)
+
+
+class ParallelAgentExecutor(AgentExecutor):
+    """
+    Agent executor which runs all tool calls of one agent step concurrently.
+
+    AgentExecutor runs the tool calls of a step one after another when it is invoked synchronously. When invoked
+    asynchronously (e.g. via LangServe), it gathers them, but runs the synchronous tools on the default executor
+    of the event loop. Here, the tool calls of both paths are submitted to a bounded thread pool as soon as they
+    are planned, and their results are yielded in the planned order, so the scratchpad stays deterministic.
+    """
+
+    def _perform_agent_action(self, name_to_tool_map, color_mapping, agent_action, run_manager=None) -> Future:
+        perform_agent_action = super()._perform_agent_action
+        # Copy the context, so callbacks & tracing of the tool run are attached to the current run
+        context = contextvars.copy_context()
+        return tool_call_pool.submit(context.run, perform_agent_action,
+                                     name_to_tool_map, color_mapping, agent_action, run_manager)
+
+    def _iter_next_step(self, name_to_tool_map, color_mapping, inputs, intermediate_steps,
+                        run_manager=None) -> Iterator[Union[AgentFinish, AgentAction, AgentStep]]:
+        futures = []
+        for step in super()._iter_next_step(name_to_tool_map, color_mapping, inputs, intermediate_steps, run_manager):
+            if isinstance(step, Future):
+                futures.append(step)
+            else:
+                yield step
+
+        if len(futures) > 1:
+            logger.debug(f"Running {len(futures)} tool calls concurrently")
+        for future in futures:
+            yield future.result()
+
+    async def _aperform_agent_action(self, name_to_tool_map, color_mapping, agent_action,
+                                     run_manager=None) -> AgentStep:
+        # The async path gathers the tool calls of a step (in the planned order), each of them runs on the shared pool
+        return await asyncio.wrap_future(self._perform_agent_action(
+            name_to_tool_map, color_mapping, agent_action, run_manager.get_sync() if run_manager else None))
@@ -1,6 +1,12 @@
 import logging
+import os
+import random
+import sqlite3
+from collections import defaultdict
+from contextlib import closing
+from functools import lru_cache
 
-from typing import List, Sequence
+from typing import List, Sequence, Optional
 
 from operator import itemgetter
 
@@ -8,7 +14,7 @@ from operator import itemgetter
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate, SystemMessagePromptTemplate, MessagesPlaceholder, HumanMessagePromptTemplate
 from langchain_core.messages import HumanMessage
-from langchain_core.runnables import RunnableParallel, RunnablePassthrough
+from langchain_core.runnables import RunnableLambda, RunnablePassthrough
 from langchain_core.language_models.base import BaseLanguageModel
 from langchain_core.vectorstores import VectorStore
 from langchain.sql_database import SQLDatabase
@@ -18,14 +24,75 @@ from langchain_core.pydantic_v1 import (
     Field,
 )
 
-from db.chroma_db import PID_METADATA_FIELD_NAME
+from agent.context_packing import pack_documents, pack_get_result, pack_texts, DEFAULT_TOOL_CONTEXT_TOKEN_BUDGET
+from db.bm25_index import BM25Index
+from db.data_dir_contents import SQLITE_DB_FILE
+from db.data_frames import PATIENT_ID_COLUMN_NAME
+from db.embedding_matrix import EmbeddingMatrix
+from db.hybrid_search import HybridSearch, DEFAULT_RETRIEVAL_MODE
+from db.journey_chunks import DEFAULT_SCORE_AGGREGATION
+from db.shared import COORDINATES_AND_CLUSTER_COLUMN_NAMES
+from db.sql_engine import GuardedSqlEngine, SqlResultCache, DEFAULT_QUERY_TIMEOUT_SECONDS, DEFAULT_MAX_RESULT_ROWS, \
+    DEFAULT_MAX_RESULT_CACHE_SIZE_MB
+from utils.get_env import get_env
 
 # Define the maximum number of documents to retrieve from the vector store in tools
 MAX_NR_OF_DOCUMENTS_TO_RETRIEVE = 5
 
+# Number of example journeys given to the synthetic patient journey generator
+MAX_NR_OF_EXAMPLE_JOURNEYS = 5
+
+# Number of synthetic patient journeys kept in memory (by journey description)
+MAX_NR_OF_CACHED_SYNTHETIC_JOURNEYS = 256
+
 logger = logging.getLogger(__name__)
 
-def create_agent_tools(model: BaseLanguageModel, db: VectorStore, sqlite_db: SQLDatabase) -> Sequence[BaseTool]:
+
+def select_example_journeys(db: VectorStore, count: int) -> List[str]:
+    """
+    Randomly selects example patient journeys, stratified by cluster (one journey per cluster, round robin),
+    so the examples cover different kinds of journeys.
+    """
+    pids_by_cluster = defaultdict(list)
+    if os.path.exists(SQLITE_DB_FILE):
+        with closing(sqlite3.connect(SQLITE_DB_FILE)) as conn:
+            cluster_column = COORDINATES_AND_CLUSTER_COLUMN_NAMES[2]
+            for pid, cluster in conn.execute(f'SELECT "{PATIENT_ID_COLUMN_NAME}", "{cluster_column}" FROM patients'):
+                pids_by_cluster[cluster].append(pid)
+    else:
+        pids_by_cluster[None] = db.get(include=[])['ids']
+
+    for pids in pids_by_cluster.values():
+        random.shuffle(pids)
+    strata = list(pids_by_cluster.values())
+    random.shuffle(strata)
+
+    selected_pids = []
+    while len(selected_pids) < count and any(strata):
+        for pids in strata:
+            if pids and len(selected_pids) < count:
+                selected_pids.append(pids.pop())
+
+    logger.info(f"Selected example patient journeys: {selected_pids}")
+    if not selected_pids:
+        return []
+    return db.get(ids=selected_pids)['documents']
+
+
+def create_agent_tools(model: BaseLanguageModel, db: VectorStore, sqlite_db: SQLDatabase,
+                       lexical_index: BM25Index, chunk_store: Optional[VectorStore] = None,
+                       embedding_matrix: Optional[EmbeddingMatrix] = None) -> Sequence[BaseTool]:
+    # Retrieved patient journeys are packed into this many tokens (per tool call)
+    token_budget = int(get_env('TOOL_CONTEXT_TOKEN_BUDGET') or DEFAULT_TOOL_CONTEXT_TOKEN_BUDGET)
+    model_name = getattr(model, 'model_name', None)
+
+    # Vector, lexical (BM25, no network access) or hybrid retrieval of relevant patient journeys.
+    # With the chunk index, only the matching parts of long journeys are returned.
+    # Searches within a cohort run on the embedding matrix (exact, no Chroma metadata filter).
+    search = HybridSearch(db, lexical_index, mode=(get_env('RETRIEVAL_MODE') or DEFAULT_RETRIEVAL_MODE).lower(),
+                          chunk_store=chunk_store, embedding_matrix=embedding_matrix,
+                          chunk_score_aggregation=(get_env('CHUNK_SCORE_AGGREGATION') or DEFAULT_SCORE_AGGREGATION).lower())
+
     # –––
     class FindPJToolInput(BaseModel):
         query: str = Field(description="A query to be used for a similarity search. The query should reflect the user's question in the sense that it represents the characteristics of the patient journey that the user is looking for.")
@@ -45,31 +112,19 @@ def create_agent_tools(model: BaseLanguageModel, db: VectorStore, sqlite_db: SQL
         It may also be used if no patient journeys could be found with other, more structured tools.
         """
 
-        filter = {}
-
-        if pids:
-            # Create filter object
-            filter = {
-                    PID_METADATA_FIELD_NAME: {
-                        '$in': pids
-                    }
-                }
-
-        retriever = db.as_retriever(
-            search_type="similarity",
-            search_kwargs={
-                "k": MAX_NR_OF_DOCUMENTS_TO_RETRIEVE,
-                "filter": filter
-            }
-        )
-        
         retrieval_chain = (
-            RunnablePassthrough(lambda x: logger.debug(f"Retreiver Input: {x} – filter: {filter}"))
-            | retriever
+            RunnablePassthrough(lambda x: logger.debug(f"Retreiver Input: {x} – pids: {pids} – mode: {search.mode}"))
+            | RunnableLambda(lambda x: search.search(x, MAX_NR_OF_DOCUMENTS_TO_RETRIEVE, pids))
+            | RunnableLambda(lambda docs: pack_documents(docs, token_budget, model_name))
             | RunnablePassthrough(lambda x: logger.debug(f"Retreiver Output: {x}"))
         )
 
         return retrieval_chain.invoke(query)
+
+    # Only the lexical & hybrid retrieval modes match exact terms
+    if search.mode != 'vector':
+        find_relevant_patient_journeys.description += \
+            '\n        Exact terms in the query (e.g. medical codes or drug names) are matched as well.'
     # –––
 
     # –––
@@ -92,7 +147,8 @@ def create_agent_tools(model: BaseLanguageModel, db: VectorStore, sqlite_db: SQL
                 "pids": itemgetter("pids"),
             }
             | RunnablePassthrough(lambda x: logger.debug(f"Getter Input: {x}"))
-            | RunnablePassthrough.assign(response = lambda x: db.get(ids=x['pids'], limit=None if x['pids'] else MAX_NR_OF_DOCUMENTS_TO_RETRIEVE))
+            | RunnablePassthrough.assign(response = lambda x: pack_get_result(
+                db.get(ids=x['pids'], limit=None if x['pids'] else MAX_NR_OF_DOCUMENTS_TO_RETRIEVE), x['pids'], token_budget, model_name))
             | RunnablePassthrough(lambda x: logger.debug(f"Getter Output: {x}"))
         )
 
@@ -103,6 +159,56 @@ def create_agent_tools(model: BaseLanguageModel, db: VectorStore, sqlite_db: SQL
     class FindSimilarPJToolInput(BaseModel):
         journey_description: str = Field(description="A rough description of a reference patient journey for to find similar patient journeys.")
 
+    similarity_system_template = """
+    You are a synthetic patient journey generator.
+
+    You will generate a synthetic patient journey based on a simple description of that journey.
+    You will use the provided examples as context to generate a synthetic patient journey in the same format and structure.
+
+    You only answer with the generated journey, no other information or annotations.
+    """
+
+    patient_journey_description_template = """
+    Please create a synthetic patient journey that matches the following description:
+
+    {journey_description}
+    """
+
+    similarity_prompt = ChatPromptTemplate.from_messages(
+        [
+            SystemMessagePromptTemplate.from_template(similarity_system_template),
+            HumanMessage(content=("Here are a few examples of patient journeys that you can use as context to generate a synthetic patient journey:")),
+            MessagesPlaceholder(variable_name='examples'),
+            HumanMessagePromptTemplate.from_template(patient_journey_description_template),
+        ]
+    )
+
+    # TODO: What is a sensible similarity score threshold? -> 0.7 for now
+    similarity_retriever = db.as_retriever(
+                                search_type="similarity_score_threshold",
+                                search_kwargs={
+                                    "score_threshold": 0.1, # Just give us "the most similar", as we only fetch k docs anyways.
+                                    "k": MAX_NR_OF_DOCUMENTS_TO_RETRIEVE
+                                    }
+                                )
+
+    # The examples are selected once, so the synthetic journeys of repeated descriptions stay comparable
+    example_journeys, _ = pack_texts(select_example_journeys(db, MAX_NR_OF_EXAMPLE_JOURNEYS), token_budget, model_name)
+
+    synthetic_journey_chain = (
+        RunnablePassthrough.assign(examples=lambda _: example_journeys)
+        | RunnablePassthrough(lambda x: logger.debug(f"Synthetic Data Generator Input: {x}"))
+        | similarity_prompt
+        | model
+        | StrOutputParser()
+        | RunnablePassthrough(lambda x: logger.info(f"Synthetic Data Generator Output: {x}"))
+    )
+
+    # Repeated descriptions skip the LLM – and the embedding of the cached journey is served by the query embedding cache
+    @lru_cache(maxsize=MAX_NR_OF_CACHED_SYNTHETIC_JOURNEYS)
+    def create_synthetic_journey(normalized_journey_description: str) -> str:
+        return synthetic_journey_chain.invoke({"journey_description": normalized_journey_description})
+
     @tool("find-similar-patient-journeys", args_schema=FindSimilarPJToolInput)
     def find_similar_patient_journeys(journey_description: str) -> List[str]:
         """
@@ -117,53 +223,10 @@ def create_agent_tools(model: BaseLanguageModel, db: VectorStore, sqlite_db: SQL
         - Do we have patient journeys that have undergone eye surgery?
         """
 
-        similarity_system_template = """
-        You are a synthetic patient journey generator.
-
-        You will generate a synthetic patient journey based on a simple description of that journey.
-        You will use the provided examples as context to generate a synthetic patient journey in the same format and structure.
-
-        You only answer with the generated journey, no other information or annotations.
-        """
-
-        patient_journey_description_template = """
-        Please create a synthetic patient journey that matches the following description:
-
-        {journey_description}
-        """
-
-        similarity_prompt = ChatPromptTemplate.from_messages(
-            [
-                SystemMessagePromptTemplate.from_template(similarity_system_template),
-                HumanMessage(content=("Here are a few examples of patient journeys that you can use as context to generate a synthetic patient journey:")),
-                MessagesPlaceholder(variable_name='examples'),
-                HumanMessagePromptTemplate.from_template(patient_journey_description_template),
-            ]
-        )
-
-        # TODO: What is a sensible similarity score threshold? -> 0.7 for now
-        # TODO: Don't exceed max token context window
-        similarity_retriever = db.as_retriever(
-                                    search_type="similarity_score_threshold",
-                                    search_kwargs={
-                                        "score_threshold": 0.1, # Just give us "the most similar", as we only fetch k docs anyways.
-                                        "k": MAX_NR_OF_DOCUMENTS_TO_RETRIEVE
-                                        }
-                                    )
-
         similarity_retrieval_chain = (
-            RunnablePassthrough.assign(examples=lambda _: db.get(limit=5)['documents']) # TODO: Get 5 random documents as examples
-            | RunnableParallel(
-            {
-                "journey_description": itemgetter("journey_description"),
-                "examples": itemgetter("examples"),
-            })
-            | RunnablePassthrough(lambda x: logger.debug(f"Synthetic Data Generator Input: {x}"))
-            | similarity_prompt
-            | model
-            | StrOutputParser()
-            | RunnablePassthrough(lambda x: logger.info(f"Synthetic Data Generator Output: {x}"))
+            RunnableLambda(lambda x: create_synthetic_journey(' '.join(x["journey_description"].split())))
             | similarity_retriever
+            | RunnableLambda(lambda docs: pack_documents(docs, token_budget, model_name))
             | RunnablePassthrough(lambda x: logger.debug(f"Similarity Retriever Output: {x}"))
         )
 
@@ -171,8 +234,15 @@ def create_agent_tools(model: BaseLanguageModel, db: VectorStore, sqlite_db: SQL
         # handle them in the client? --> Maybe return a list of PIDs and highlight them in the app?
         return similarity_retrieval_chain.invoke({"journey_description": journey_description})
     # –––
+    # LLM generated queries run read-only, with a time limit and a limited number of result rows.
+    # Results of repeated queries are served from memory until the data changes.
+    sql_engine = GuardedSqlEngine(
+        timeout_seconds=float(get_env('SQL_QUERY_TIMEOUT_SECONDS') or DEFAULT_QUERY_TIMEOUT_SECONDS),
+        max_rows=int(get_env('SQL_MAX_RESULT_ROWS') or DEFAULT_MAX_RESULT_ROWS),
+        result_cache=SqlResultCache(
+            max_size_bytes=int(get_env('SQL_RESULT_CACHE_MAX_MB') or DEFAULT_MAX_RESULT_CACHE_SIZE_MB) * 1024 * 1024),
+    )
 
-    # –––
     class FindPJStructuredToolInput(BaseModel):
         sqliteQuery: str = Field(description="A SQLite syntax compatible query (avoid ```sql or other markup) based on the database schema in the description, that would fetch the necessary data to answer the user's question.")
 
@@ -192,7 +262,7 @@ def create_agent_tools(model: BaseLanguageModel, db: VectorStore, sqlite_db: SQL
 
         def run_query(query: str):
             try:
-                return sqlite_db.run(query)
+                return sql_engine.run(query)
             except Exception as e:
                 return str(e)
 
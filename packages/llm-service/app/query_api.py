@@ -0,0 +1,81 @@
+import json
+import sqlite3
+from typing import List, Optional, Any
+
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
+from langchain.pydantic_v1 import BaseModel, Field
+
+from db.sqlite_queries import connect_read_only, get_columns, build_query, execute_query, stream_rows, \
+    InvalidQueryError, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+
+# REST endpoints to load cohorts & timelines on demand (instead of the full /patients and /events files)
+
+router = APIRouter(prefix="/query")
+
+
+class FilterInput(BaseModel):
+    column: str
+    op: str = Field(description="eq | ne | lt | lte | gt | gte | in")
+    value: Any
+
+
+class PatientsQueryInput(BaseModel):
+    columns: Optional[List[str]] = None
+    filters: List[FilterInput] = []
+    cursor: Optional[str] = None
+    limit: int = Field(DEFAULT_PAGE_SIZE, gt=0, le=MAX_PAGE_SIZE)
+
+
+class EventsQueryInput(BaseModel):
+    columns: Optional[List[str]] = None
+    pids: Optional[List[str]] = None
+    filters: List[FilterInput] = []
+    cursor: Optional[str] = None
+    limit: int = Field(DEFAULT_PAGE_SIZE, gt=0, le=MAX_PAGE_SIZE)
+
+
+def stream_query(table: str, columns: Optional[List[str]], filters: List[FilterInput], pids: Optional[List[str]],
+                 cursor: Optional[str], limit: int) -> StreamingResponse:
+    conn = connect_read_only()
+    try:
+        sql, params, selected_columns = build_query(table, get_columns(conn, table), columns,
+                                                    [f.dict() for f in filters], pids, cursor, limit)
+        # Executed before the response is started, so SQL errors are still reported with a proper status code
+        rows = stream_rows(*execute_query(conn, sql, params))
+    except (InvalidQueryError, ValueError) as e:
+        conn.close()
+        raise HTTPException(status_code=400, detail=str(e))
+    except sqlite3.Error as e:
+        conn.close()
+        raise HTTPException(status_code=500, detail=f"Query failed: {e}")
+
+    # The page is streamed as: {"columns": [...], "rows": [[...], ...], "next_cursor": "..." | null}
+    def generate():
+        try:
+            yield '{"columns": ' + json.dumps(selected_columns) + ', "rows": ['
+            count = 0
+            last_rowid = None
+            next_cursor = None
+            for rowid, *values in rows:
+                if count == limit:
+                    next_cursor = str(last_rowid)
+                    break
+                yield (', ' if count else '') + json.dumps(values)
+                count += 1
+                last_rowid = rowid
+            yield '], "next_cursor": ' + json.dumps(next_cursor) + '}'
+        finally:
+            conn.close()
+
+    return StreamingResponse(generate(), media_type="application/json")
+
+
+@router.post("/patients")
+def query_patients(query: PatientsQueryInput):
+    return stream_query('patients', query.columns, query.filters, None, query.cursor, query.limit)
+
+
+@router.post("/events")
+def query_events(query: EventsQueryInput):
+    return stream_query('events', query.columns, query.filters, query.pids, query.cursor, query.limit)
@@ -0,0 +1,107 @@
+import os
+from typing import Dict, Optional, Tuple
+
+from fastapi import Request, Response
+from fastapi.responses import FileResponse, StreamingResponse
+
+from utils.precompressed import PrecompressedContent, PrecompressedFile, Precompressed, matches_etag
+
+# Clients may keep the data, but have to revalidate it (via ETag) before using it
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+RANGE_CHUNK_SIZE = 64 * 1024
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def create_representation_headers(content: Precompressed, encoding: str, headers: Dict[str, str]) -> Dict[str, str]:
+    response_headers = {
+        "Vary": "Accept-Encoding",
+        **headers,
+        "ETag": content.etag(encoding),
+        "Cache-Control": REVALIDATE_CACHE_CONTROL,
+    }
+    if encoding != 'identity':
+        response_headers["Content-Encoding"] = encoding
+    return response_headers
+
+
+def create_precompressed_response(request: Request, content: PrecompressedContent, media_type: str,
+                                  headers: Dict[str, str]) -> Response:
+    encoding = content.select_encoding(request.headers.get('accept-encoding'))
+    response_headers = create_representation_headers(content, encoding, headers)
+
+    if matches_etag(request.headers.get('if-none-match'), content.etag(encoding)):
+        return Response(status_code=304, headers=response_headers)
+
+    return Response(content.representations[encoding], media_type=media_type, headers=response_headers)
+
+
+def parse_range(range_header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    Returns the (inclusive) byte range requested by a "Range: bytes=..." header.
+    Multiple ranges are not supported, such requests are answered with the full content.
+    """
+    if not range_header or not range_header.startswith('bytes=') or ',' in range_header:
+        return None
+    start, _, end = range_header[len('bytes='):].strip().partition('-')
+    try:
+        if not start:
+            # Suffix range, e.g. the last 500 bytes: "bytes=-500"
+            suffix_length = int(end)
+            if suffix_length == 0:
+                raise RangeNotSatisfiable()
+            return max(0, size - suffix_length), size - 1
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+    except ValueError:
+        return None
+    if start >= size or start > end:
+        raise RangeNotSatisfiable()
+    return start, end
+
+
+def read_file_range(file_path: str, start: int, end: int):
+    with open(file_path, 'rb') as file:
+        file.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = file.read(min(RANGE_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def create_precompressed_file_response(request: Request, content: PrecompressedFile, media_type: str,
+                                       filename: str, headers: Dict[str, str] = None) -> Response:
+    encoding = content.select_encoding(request.headers.get('accept-encoding'))
+    etag = content.etag(encoding)
+    response_headers = create_representation_headers(content, encoding, {
+        **(headers or {}),
+        "Accept-Ranges": "bytes",
+        "Content-Disposition": f"attachment; filename={filename}",
+    })
+
+    if matches_etag(request.headers.get('if-none-match'), etag):
+        return Response(status_code=304, headers=response_headers)
+
+    file_path = content.representations[encoding]
+    size = os.path.getsize(file_path)
+
+    # Ranges refer to the selected (encoded) representation and are ignored if If-Range does not match it
+    if_range = request.headers.get('if-range')
+    if if_range is None or if_range == etag:
+        try:
+            byte_range = parse_range(request.headers.get('range'), size)
+        except RangeNotSatisfiable:
+            return Response(status_code=416, headers={**response_headers, "Content-Range": f"bytes */{size}"})
+        if byte_range is not None:
+            start, end = byte_range
+            return StreamingResponse(read_file_range(file_path, start, end), status_code=206, media_type=media_type,
+                                     headers={**response_headers,
+                                              "Content-Range": f"bytes {start}-{end}/{size}",
+                                              "Content-Length": str(end - start + 1)})
+
+    return FileResponse(file_path, media_type=media_type, headers=response_headers)
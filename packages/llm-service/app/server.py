@@ -1,20 +1,30 @@
 import logging
+import threading
+from contextlib import asynccontextmanager
 from operator import itemgetter
-from typing import List
+from typing import List, Any, Dict, Optional, Iterator, AsyncIterator, Type
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import RedirectResponse, FileResponse
-from fastapi.responses import PlainTextResponse
+from fastapi.responses import RedirectResponse, JSONResponse
 from langchain.globals import set_verbose
-from langchain.pydantic_v1 import BaseModel
-from langchain_core.runnables import RunnableParallel, RunnablePassthrough
+from langchain.pydantic_v1 import BaseModel, Field
+from langchain_core.runnables import Runnable, RunnableConfig, RunnableParallel, RunnablePassthrough
 from langserve import add_routes
 
 from agent.agent import create_agent
-from data.init_data import init_data
-from db.data_dir_contents import EVENTS_CSV
+from app.query_api import router as query_router
+from app.responses import create_precompressed_response, create_precompressed_file_response
+from data.init_data import init_data, CSV_MEDIA_TYPE
+from db.cohort_clustering import CohortClustering, DEFAULT_COHORT_CLUSTERING_CACHE_SIZE
+from db.columnar_export import ARROW_MEDIA_TYPE
+from db.data_dir_contents import INIT_LOCK_FILE
+from db.data_frames import PATIENT_ID_COLUMN_NAME
+from db.sqlite_db import SchemaDescription
+from utils.file_lock import file_lock
 from utils.get_env import get_env
+from utils.precompressed import parse_quality_values
+from utils.startup_progress import startup_progress
 
 # set_debug(True)
 set_verbose(True)
@@ -26,16 +36,102 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
-# Initialize the data
-vector_store, structured_db, patients_csv = init_data()
+# Requests to these endpoints are answered with 503 until the data is initialized
+DATA_PATH_PREFIXES = ('/rag', '/patients', '/events', '/query', '/cohort')
+RETRY_AFTER_SECONDS = 10
+
+# Set by the background initialization (the server accepts requests right away, see lifespan below)
+schema_description = None
+cohort_clustering = None
+agent_executor = None
+patients_csv = None
+events_files = None
+
+
+def initialize():
+    global schema_description, cohort_clustering, agent_executor, patients_csv, events_files
+    try:
+        # Each uvicorn worker initializes itself, but only one at a time writes the data dir. The others wait and then
+        # find the data up to date (and only load it)
+        with file_lock(INIT_LOCK_FILE,
+                       on_wait=lambda: startup_progress.start_phase('Waiting for the initialization of another worker')):
+            # Initialize the data
+            vector_store, structured_db, lexical_index, chunk_store, embedding_matrix, patients_csv, events_files = \
+                init_data()
+
+        # The schema is only computed again when the SQLite DB changes. It is computed (or loaded) right away, so the
+        # first question doesn't have to wait for it
+        startup_progress.start_phase('Describing SQLite schema')
+        schema_description = SchemaDescription(structured_db)
+        schema_description.get()
+
+        # Re-cluster selected cohorts on demand. The first clustering compiles UMAP, which is done right away, so the
+        # first cohort request doesn't have to wait for it
+        startup_progress.start_phase('Warming up cohort clustering')
+        cohort_clustering = CohortClustering(embedding_matrix, int(get_env('COHORT_CLUSTERING_CACHE_SIZE')
+                                                                   or DEFAULT_COHORT_CLUSTERING_CACHE_SIZE))
+        cohort_clustering.warm_up()
+
+        startup_progress.start_phase('Creating agent')
+
+        # Create the agent
+        agent_executor = create_agent(vector_store, structured_db, lexical_index, chunk_store, embedding_matrix)
+        startup_progress.finish()
+    except Exception as e:
+        # The error is reported via /healthz & /readyz
+        logger.exception(e)
+        startup_progress.fail(e)
+
+
+# Add typing for input with only chat history
+class ChatInput(BaseModel):
+    conversation: List[dict]
+    selected_patient: str = None
+    cohort: List[str] = None
+
+
+class AgentInput(ChatInput):
+    last_question: str
+    schema_description: str = Field(alias='schema')
+
+
+class AgentOutput(AgentInput):
+    output: str
+
+
+class ReadyAgentExecutor(Runnable[Dict[str, Any], Dict[str, Any]]):
+    """
+    Delegates to the agent executor, which only exists once the initialization has finished (requests before are
+    rejected with 503). Declares the input & output of the executor, which are untyped on the executor itself.
+    """
+
+    def get_input_schema(self, config: Optional[RunnableConfig] = None) -> Type[BaseModel]:
+        return AgentInput
+
+    def get_output_schema(self, config: Optional[RunnableConfig] = None) -> Type[BaseModel]:
+        return AgentOutput
+
+    def invoke(self, input: Dict[str, Any], config: Optional[RunnableConfig] = None, **kwargs: Any) -> Dict[str, Any]:
+        return agent_executor.invoke(input, config, **kwargs)
+
+    async def ainvoke(self, input: Dict[str, Any], config: Optional[RunnableConfig] = None,
+                      **kwargs: Any) -> Dict[str, Any]:
+        return await agent_executor.ainvoke(input, config, **kwargs)
+
+    def stream(self, input: Dict[str, Any], config: Optional[RunnableConfig] = None,
+               **kwargs: Any) -> Iterator[Dict[str, Any]]:
+        yield from agent_executor.stream(input, config, **kwargs)
+
+    async def astream(self, input: Dict[str, Any], config: Optional[RunnableConfig] = None,
+                      **kwargs: Any) -> AsyncIterator[Dict[str, Any]]:
+        async for chunk in agent_executor.astream(input, config, **kwargs):
+            yield chunk
 
-# Create the agent
-agent_executor = create_agent(vector_store, structured_db)
 
 # Define the agent chain
 chain = (
         RunnablePassthrough.assign(last_question=lambda x: x["conversation"][-1]['content'])
-        | RunnablePassthrough.assign(schema=lambda _: structured_db.get_table_info())
+        | RunnablePassthrough.assign(schema=lambda _: schema_description.get())
         | RunnableParallel(
                 {
                     "conversation": itemgetter("conversation"),
@@ -45,21 +141,36 @@ chain = (
                     "cohort": itemgetter("cohort"),
                 }
             )
-        | agent_executor
+        | ReadyAgentExecutor()
         | RunnablePassthrough(lambda x: logger.debug(f"Chain Ouput: {x}"))
 )
 
+chain = chain.with_types(input_type=ChatInput, output_type=AgentOutput)
+
+
+class CohortInput(BaseModel):
+    pids: List[str]
 
-# Add typing for input with only chat history
-class ChatInput(BaseModel):
-    conversation: List[dict]
-    selected_patient: str = None
-    cohort: List[str] = None
 
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    # The initialization may take long (e.g. embedding & clustering), so it runs in the background and the server
+    # binds its port immediately
+    threading.Thread(target=initialize, name='initialize', daemon=True).start()
+    yield
 
-chain = chain.with_types(input_type=ChatInput)
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+
+
+@app.middleware("http")
+async def reject_until_ready(request: Request, call_next):
+    if not startup_progress.ready and request.url.path.startswith(DATA_PATH_PREFIXES):
+        return JSONResponse(status_code=503, content={"detail": "The service is still initializing",
+                                                      **startup_progress.status()},
+                            headers={"Retry-After": str(RETRY_AFTER_SECONDS)})
+    return await call_next(request)
+
 
 app.add_middleware(
     CORSMiddleware,
@@ -75,16 +186,53 @@ async def redirect_root_to_docs():
     return RedirectResponse("/docs")
 
 
+@app.get("/healthz")
+async def get_liveness():
+    # A failed initialization is reported as not live, so the orchestrator restarts the service
+    if startup_progress.error is not None:
+        return JSONResponse(status_code=500, content={"status": "failed", "error": startup_progress.error})
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+async def get_readiness():
+    status = startup_progress.status()
+    if not status['ready']:
+        return JSONResponse(status_code=503, content=status, headers={"Retry-After": str(RETRY_AFTER_SECONDS)})
+    return status
+
+
 @app.get("/patients")
-async def get_patients_data():
-    return PlainTextResponse(patients_csv, media_type="text/csv",
-                             headers={"Content-Disposition": "attachment; filename=patients.csv", "Cache-Control": "no-store, max-age=0"})
+async def get_patients_data(request: Request):
+    return create_precompressed_response(request, patients_csv, media_type="text/csv",
+                                         headers={"Content-Disposition": "attachment; filename=patients.csv"})
 
 
 @app.get("/events")
-async def get_events_data():
-    return FileResponse(EVENTS_CSV, media_type='text/csv', filename='events.csv', headers={"Cache-Control": "no-store, max-age=0"})
-
+async def get_events_data(request: Request):
+    # The columnar (Arrow IPC) variant is served to clients which prefer it over CSV
+    accepted = parse_quality_values(request.headers.get('accept'))
+    if ARROW_MEDIA_TYPE in events_files and accepted.get(ARROW_MEDIA_TYPE, 0) > accepted.get(CSV_MEDIA_TYPE, 0):
+        return create_precompressed_file_response(request, events_files[ARROW_MEDIA_TYPE], media_type=ARROW_MEDIA_TYPE,
+                                                  filename='events.arrow', headers={"Vary": "Accept, Accept-Encoding"})
+    return create_precompressed_file_response(request, events_files[CSV_MEDIA_TYPE], media_type=CSV_MEDIA_TYPE,
+                                              filename='events.csv', headers={"Vary": "Accept, Accept-Encoding"})
+
+
+@app.post("/cohort/clusters")
+def cluster_cohort(cohort: CohortInput):
+    try:
+        df = cohort_clustering.cluster(cohort.pids)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    # Same shape as the query endpoints: {"columns": [...], "rows": [[...], ...]}
+    return {
+        "columns": [PATIENT_ID_COLUMN_NAME, *df.columns],
+        "rows": [[pid, x, y, cluster] for pid, x, y, cluster in df.itertuples(name=None)],
+    }
+
+
+app.include_router(query_router)
 
 add_routes(app, chain, path="/rag")
 
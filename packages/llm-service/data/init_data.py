@@ -1,24 +1,35 @@
 import csv
 import logging
 import os
-import ast
+import sqlite3
+from contextlib import closing
 from io import StringIO
+from typing import List, Tuple, Dict
 
 import pandas as pd
-from langchain.sql_database import SQLDatabase
 
+from db.bm25_index import init_bm25_index
 from db.chroma_db import init_chroma_db
-from db.data_dir_contents import DATA_DIR, PATIENTS_CSV, PATIENT_REPORTS_TXT, EVENTS_CSV, HASH_FILE
+from db.columnar_export import init_events_arrow, ARROW_MEDIA_TYPE
+from db.data_dir_contents import DATA_DIR, PATIENTS_CSV, PATIENT_REPORTS_TXT, EVENTS_CSV, HASH_FILE, SQLITE_DB_FILE, \
+    HTTP_CACHE_DIR
 from db.data_frames import concat_coordinates_and_cluster_to_patients
-from db.data_frames import load_data_frames
-from db.prepare_patient_journeys import init_patient_journeys
+from db.data_frames import load_data_frames, PATIENT_ID_COLUMN_NAME
+from db.embedding_matrix import init_embedding_matrix
+from db.journey_chunks import init_chunk_index, is_chunk_index_enabled
+from db.manifest import create_manifest, load_manifest, save_manifest, diff_manifests, has_changes
+from db.prepare_patient_journeys import init_patient_journeys, refresh_patient_journeys
 from db.shared import COORDINATES_AND_CLUSTER_COLUMN_NAMES, COORDINATES_AND_CLUSTER_COLUMN_TYPES, DATE_FORMAT
 from db.sqlite_db import init_sqlite_db
 from utils.get_env import get_env
 from utils.hash import calculate_hash
+from utils.precompressed import PrecompressedContent, PrecompressedFile
+from utils.startup_progress import startup_progress
 
 logger = logging.getLogger(__name__)
 
+CSV_MEDIA_TYPE = 'text/csv'
+
 
 def init_data():
     logger.info(f"Initializing data from {DATA_DIR} ...")
@@ -41,23 +52,40 @@ Your current settings:
         raise ValueError(error_msg)
 
     # Load patients & events data frames
+    startup_progress.start_phase('Loading data frames')
     data_frames = load_data_frames()
 
+    # Create a per-patient manifest and find out which patient journeys changed since last run
+    startup_progress.start_phase('Comparing manifests')
+    manifest = create_manifest(data_frames)
+    old_manifest = load_manifest()
+    diff = None
+    if os.path.exists(HASH_FILE) and old_manifest is not None and is_incremental_refresh_enabled():
+        diff = diff_manifests(old_manifest, manifest)
+        if has_changes(diff):
+            logger.info(f"Incremental data refresh: {len(diff['added'])} added, {len(diff['changed'])} changed, "
+                        f"{len(diff['removed'])} removed patients")
+            refresh_patient_journeys(data_frames, diff['added'] | diff['changed'])
+
     # Initialize the patient journeys
+    startup_progress.start_phase('Preparing patient journeys')
     init_patient_journeys(data_frames)
 
     # Create hash from input files and check if they changed
     # –––
     # Concatenate the contents of the three files and pipe to md5sum to get a single checksum
+    startup_progress.start_phase('Checking data consistency')
     hash = calculate_hash(PATIENTS_CSV, EVENTS_CSV, PATIENT_REPORTS_TXT)
 
     if os.path.exists(HASH_FILE):
         with open(HASH_FILE, 'r') as file:
             old_hash = file.read().strip()
-            if old_hash == hash:
-                logger.info("Data consistency check passed, no changes since last run")
-            else:
-                error_msg = """
+        if old_hash == hash:
+            logger.info("Data consistency check passed, no changes since last run")
+        elif has_changes(diff):
+            logger.info("Data is refreshed incrementally")
+        else:
+            error_msg = """
 🚨 The data you are loading has changed since last run!
 
 Please make sure that you have the right patients, events and patient reports files.
@@ -68,49 +96,103 @@ If you want to proceed with new data, please…
 - Delete the SQLite data file
 
 …and restart the service.
+
+(Set DATA_REFRESH_MODE=incremental to refresh changed patient journeys only. This requires a manifest
+file from a previous run.)
 """
 
-                logger.error(error_msg)
-                raise ValueError(error_msg)
+            logger.error(error_msg)
+            raise ValueError(error_msg)
     else:
-        # Write the hash to the file
-        with open(HASH_FILE, 'w') as file:
-            file.write(hash)
-            logger.info("Data loaded for the first time, hash written to file")
+        logger.info("Data is loaded for the first time")
     # –––
 
     # Initialize the vector store
-    vector_store = init_chroma_db(len(data_frames['patients']))
+    startup_progress.start_phase('Embedding patient journeys')
+    outdated_doc_ids = diff['changed'] | diff['removed'] if has_changes(diff) else set()
+    vector_store = init_chroma_db(len(data_frames['patients']), outdated_doc_ids)
+
+    # Export the embeddings as memory-mapped matrix (for exact searches within cohorts & cohort clustering)
+    startup_progress.start_phase('Exporting embedding matrix')
+    embedding_matrix = init_embedding_matrix(vector_store, hash, outdated_doc_ids)
+
+    # Initialize the chunk-level index of the patient journeys (optional, since it doubles the embedding costs)
+    chunk_store = None
+    if is_chunk_index_enabled():
+        startup_progress.start_phase('Indexing patient journey chunks')
+        chunk_store = init_chunk_index(vector_store, data_frames, manifest)
+
+    # Initialize the lexical index (rebuilt whenever the patient journey reports changed)
+    startup_progress.start_phase('Building lexical index')
+    lexical_index = init_bm25_index()
 
     # Initialize the SQLite database
-    structured_db = init_sqlite_db(data_frames, vector_store)
+    startup_progress.start_phase('Preparing SQLite database & clusters')
+    structured_db = init_sqlite_db(data_frames, vector_store, diff)
+
+    # The hash & manifest are only written once all stores are up to date: If the initialization fails or is
+    # interrupted, the next run detects the same changes again and repeats the refresh
+    write_hash(hash)
+    save_manifest(manifest)
 
     # Create patients CSV (based on data frames & coordinates/clusters from DB)
-    patients_csv = create_patients_csv(data_frames['patients'], structured_db)
+    startup_progress.start_phase('Creating patients CSV')
+    patients_csv = create_patients_csv(data_frames['patients'])
+
+    # Prepare the compressed & columnar representations of the events
+    startup_progress.start_phase('Preparing events files')
+    events_files = create_events_files(data_frames['events'])
+
+    return vector_store, structured_db, lexical_index, chunk_store, embedding_matrix, patients_csv, events_files
+
 
-    return vector_store, structured_db, patients_csv
+def write_hash(hash: str):
+    temporary_path = HASH_FILE + '.tmp'
+    with open(temporary_path, 'w') as file:
+        file.write(hash)
+    os.replace(temporary_path, HASH_FILE)
+    logger.info("Data hash written to file")
 
 
-def create_patients_csv(patients_df: pd.DataFrame, db: SQLDatabase) -> str:
+def is_incremental_refresh_enabled() -> bool:
+    return (get_env('DATA_REFRESH_MODE') or 'strict').lower() == 'incremental'
+
+
+def read_header_rows(file_path: str) -> Tuple[List[str], List[str]]:
+    # The first two rows contain the column names and the column types
+    with open(file_path, 'r', newline='') as file:
+        csv_reader = csv.reader(file)
+        return next(csv_reader), next(csv_reader)
+
+
+def create_patients_csv(patients_df: pd.DataFrame) -> PrecompressedContent:
     output = StringIO()
     csv_writer = csv.writer(output, lineterminator='\n')
 
-    # Reconstruct patient journey column names
-    column_headers = pd.read_csv(PATIENTS_CSV, nrows=1, header=None).iloc[0].astype(str).tolist()
-    column_headers.extend(COORDINATES_AND_CLUSTER_COLUMN_NAMES)
-    csv_writer.writerow(column_headers)
-
-    # Reconstruct patient journey column types
-    column_type_headers = pd.read_csv(PATIENTS_CSV, skiprows=1, nrows=1, header=None).iloc[0].astype(str).tolist()
-    column_type_headers.extend(COORDINATES_AND_CLUSTER_COLUMN_TYPES)
-    csv_writer.writerow(column_type_headers)
+    # Reconstruct patient journey column names & types
+    column_headers, column_type_headers = read_header_rows(PATIENTS_CSV)
+    csv_writer.writerow(column_headers + COORDINATES_AND_CLUSTER_COLUMN_NAMES)
+    csv_writer.writerow(column_type_headers + COORDINATES_AND_CLUSTER_COLUMN_TYPES)
 
-    # Concatenate coordinates & clusters from SQL db
-    column_names = ', '.join('\"' + col + '\"' for col in COORDINATES_AND_CLUSTER_COLUMN_NAMES)
-    result_string = db.run(f'SELECT {column_names} from patients')
-    result_list_of_triplets = ast.literal_eval(result_string)
-    coordinates_and_clusters_df = pd.DataFrame(result_list_of_triplets, columns=COORDINATES_AND_CLUSTER_COLUMN_NAMES)
+    # Concatenate coordinates & clusters from SQL db (matched by patient ID, since refreshed rows are appended)
+    column_names = ', '.join('\"' + col + '\"' for col in [PATIENT_ID_COLUMN_NAME, *COORDINATES_AND_CLUSTER_COLUMN_NAMES])
+    with closing(sqlite3.connect(SQLITE_DB_FILE)) as conn:
+        coordinates_and_clusters_df = pd.read_sql(f'SELECT {column_names} from patients', conn,
+                                                  index_col=PATIENT_ID_COLUMN_NAME)
+    coordinates_and_clusters_df = coordinates_and_clusters_df \
+        .reindex(patients_df[PATIENT_ID_COLUMN_NAME]).reset_index(drop=True)
 
     df = concat_coordinates_and_cluster_to_patients(patients_df, coordinates_and_clusters_df)
     df.to_csv(output, index=False, date_format=DATE_FORMAT, header=False)
-    return output.getvalue()
+    return PrecompressedContent(output.getvalue().encode('utf-8'))
+
+
+def create_events_files(events_df: pd.DataFrame) -> Dict[str, PrecompressedFile]:
+    events_csv = PrecompressedFile(EVENTS_CSV, HTTP_CACHE_DIR)
+    events_files = {CSV_MEDIA_TYPE: events_csv}
+
+    events_arrow_path = init_events_arrow(events_df, events_csv.hash)
+    if events_arrow_path is not None:
+        events_files[ARROW_MEDIA_TYPE] = PrecompressedFile(events_arrow_path, HTTP_CACHE_DIR)
+
+    return events_files
@@ -0,0 +1,124 @@
+import logging
+import os
+import re
+import time
+from collections import Counter
+from typing import List, Optional, Tuple, Dict
+
+import numpy as np
+
+from db.data_dir_contents import BM25_INDEX_FILE, PATIENT_REPORTS_TXT
+from utils.hash import calculate_hash
+
+# Local lexical (BM25) index over the patient journey reports.
+# Exact terms like medical codes or drug names are found without an embedding request.
+# The inverted index is stored in CSR layout (postings of term i at offsets[i]:offsets[i + 1]) and persisted
+# together with the hash of the reports file, so it is only rebuilt when the reports change.
+
+logger = logging.getLogger(__name__)
+
+# BM25 parameters (the common defaults)
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Words with inner dots, dashes or slashes (e.g. ICD codes like E11.9) are kept as one token
+TOKEN_PATTERN = re.compile(r'\w+(?:[./-]\w+)*')
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_PATTERN.findall(text.casefold())
+
+
+class BM25Index:
+    def __init__(self, pids: np.ndarray, doc_lengths: np.ndarray, terms: np.ndarray, offsets: np.ndarray,
+                 doc_indices: np.ndarray, term_frequencies: np.ndarray, source_hash: str):
+        self.pids = pids
+        self.doc_lengths = doc_lengths
+        self.terms = terms
+        self.offsets = offsets
+        self.doc_indices = doc_indices
+        self.term_frequencies = term_frequencies
+        self.source_hash = source_hash
+
+        self.term_ids: Dict[str, int] = {term: i for i, term in enumerate(terms.tolist())}
+        self.pid_indices: Dict[str, int] = {pid: i for i, pid in enumerate(pids.tolist())}
+        average_length = doc_lengths.mean() if len(doc_lengths) else 1.0
+        # The length normalization only depends on the document, so it is computed once
+        self.length_norms = BM25_K1 * (1 - BM25_B + BM25_B * doc_lengths / average_length)
+
+    @classmethod
+    def build(cls, file_path: str, source_hash: str) -> 'BM25Index':
+        pids = []
+        doc_lengths = []
+        postings: Dict[str, List[Tuple[int, int]]] = {}
+        with open(file_path, 'r', encoding='utf-8') as file:
+            for doc_index, line in enumerate(file):
+                pids.append(line.split()[0])
+                tokens = tokenize(line)
+                doc_lengths.append(len(tokens))
+                for term, frequency in Counter(tokens).items():
+                    postings.setdefault(term, []).append((doc_index, frequency))
+
+        terms = sorted(postings)
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(postings[term]) for term in terms])
+        doc_indices = np.empty(offsets[-1], dtype=np.int32)
+        term_frequencies = np.empty(offsets[-1], dtype=np.float32)
+        for i, term in enumerate(terms):
+            doc_indices[offsets[i]:offsets[i + 1]], term_frequencies[offsets[i]:offsets[i + 1]] = zip(*postings[term])
+
+        return cls(np.array(pids), np.array(doc_lengths, dtype=np.float32), np.array(terms), offsets,
+                   doc_indices, term_frequencies, source_hash)
+
+    @classmethod
+    def load(cls, file_path: str) -> 'BM25Index':
+        with np.load(file_path) as data:
+            return cls(data['pids'], data['doc_lengths'], data['terms'], data['offsets'], data['doc_indices'],
+                       data['term_frequencies'], str(data['source_hash']))
+
+    def save(self, file_path: str):
+        # Write to a temporary file first, so an interrupted run never leaves a truncated index behind
+        temporary_path = file_path + '.tmp.npz'
+        np.savez(temporary_path, pids=self.pids, doc_lengths=self.doc_lengths, terms=self.terms, offsets=self.offsets,
+                 doc_indices=self.doc_indices, term_frequencies=self.term_frequencies,
+                 source_hash=np.array(self.source_hash))
+        os.replace(temporary_path, file_path)
+
+    def search(self, query: str, k: int, pids: Optional[List[str]] = None) -> List[Tuple[str, float]]:
+        """Returns the PIDs and scores of the k best matching patient journeys (optionally only within the given PIDs)."""
+        scores = np.zeros(len(self.pids), dtype=np.float32)
+        for term in set(tokenize(query)):
+            term_id = self.term_ids.get(term)
+            if term_id is None:
+                continue
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            doc_indices = self.doc_indices[start:end]
+            term_frequencies = self.term_frequencies[start:end]
+            idf = np.log(1 + (len(self.pids) - (end - start) + 0.5) / ((end - start) + 0.5))
+            scores[doc_indices] += idf * term_frequencies * (BM25_K1 + 1) / (term_frequencies + self.length_norms[doc_indices])
+
+        if pids:
+            candidates = np.array([self.pid_indices[pid] for pid in pids if pid in self.pid_indices], dtype=np.int64)
+        else:
+            candidates = np.flatnonzero(scores)
+        candidates = candidates[scores[candidates] > 0]
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k)[:k]]
+        candidates = candidates[np.argsort(-scores[candidates], kind='stable')]
+        return [(self.pids[i], float(scores[i])) for i in candidates]
+
+
+def init_bm25_index() -> BM25Index:
+    source_hash = calculate_hash(PATIENT_REPORTS_TXT)
+    if os.path.exists(BM25_INDEX_FILE):
+        index = BM25Index.load(BM25_INDEX_FILE)
+        if index.source_hash == source_hash:
+            logger.info(f"Lexical index {BM25_INDEX_FILE} is up to date")
+            return index
+
+    start_time = time.time()
+    index = BM25Index.build(PATIENT_REPORTS_TXT, source_hash)
+    index.save(BM25_INDEX_FILE)
+    logger.info(f"Lexical index with {len(index.terms)} terms over {len(index.pids)} patient journeys has been "
+                f"created in {time.time() - start_time:.1f} seconds")
+    return index
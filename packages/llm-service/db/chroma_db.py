@@ -1,6 +1,7 @@
 import logging
 import time
-from typing import List, Any, Set
+from functools import lru_cache
+from typing import List, Any, Set, Optional
 
 from langchain.chains.query_constructor.base import AttributeInfo
 from langchain_community.vectorstores import Chroma
@@ -8,7 +9,11 @@ from langchain_core.documents import Document
 from langchain_core.embeddings import Embeddings
 from langchain_openai import OpenAIEmbeddings, AzureOpenAIEmbeddings
 
-from db.data_dir_contents import CHROMA_PERSIST_DIR, PATIENT_REPORTS_TXT
+from db.data_dir_contents import CHROMA_PERSIST_DIR, PATIENT_REPORTS_TXT, EMBEDDING_CACHE_FILE, LOCAL_EMBEDDING_MODEL_FILE
+from db.embedding_cache import EmbeddingCache, QueryEmbeddingCache, DEFAULT_MAX_CACHE_SIZE_MB, \
+    DEFAULT_MAX_QUERY_CACHE_ENTRIES
+from db.embedding_ingestion import ingest_documents, DEFAULT_MAX_IN_FLIGHT
+from db.local_embeddings import LocalEmbeddings, DEFAULT_LOCAL_EMBEDDING_DIMENSIONS
 from utils.get_env import get_env
 
 # Creates a Chroma DB instance containing embedded patient journey reports
@@ -19,6 +24,10 @@ logger = logging.getLogger(__name__)
 # OpenAI: 2048
 # Azure: 16 https://learn.microsoft.com/en-us/azure/ai-services/openai/reference#embeddings
 NR_OF_DOCS_TO_EMBED_AT_ONCE = 16
+# Local: no request size limit, larger batches are transformed on all cores
+NR_OF_DOCS_TO_EMBED_LOCALLY_AT_ONCE = 4096
+
+NR_OF_DOCS_TO_DELETE_AT_ONCE = 1000
 
 PID_METADATA_FIELD_NAME = 'PID'
 
@@ -48,12 +57,33 @@ def create_documents(file_path: str, doc_ids_to_ignore: Set[str]) -> List[Docume
 
 class LoggingEmbeddingsDecorator(Embeddings):
     delegate: Embeddings
+    cache: Optional[EmbeddingCache]
+    query_cache: Optional[QueryEmbeddingCache]
 
-    def __init__(self, delegate: Embeddings, /, **data: Any):
+    def __init__(self, delegate: Embeddings, /, cache: Optional[EmbeddingCache] = None,
+                 query_cache: Optional[QueryEmbeddingCache] = None, **data: Any):
         super().__init__(**data)
         self.delegate = delegate
+        self.cache = cache
+        self.query_cache = query_cache
 
     def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if self.cache is None:
+            return self.embed_documents_uncached(texts)
+
+        # Only embed the texts which are not cached yet
+        result = self.cache.get_many(texts)
+        missing_indices = [i for i, vector in enumerate(result) if vector is None]
+        if missing_indices:
+            missing_texts = [texts[i] for i in missing_indices]
+            embedded = self.embed_documents_uncached(missing_texts)
+            self.cache.put_many(missing_texts, embedded)
+            for i, vector in zip(missing_indices, embedded):
+                result[i] = vector
+        logger.debug(f"Embedding cache: {len(texts) - len(missing_indices)}/{len(texts)} hits, {self.cache.stats()}")
+        return result
+
+    def embed_documents_uncached(self, texts: List[str]) -> List[List[float]]:
         if logger.isEnabledFor(logging.DEBUG):
             logger.debug(f"Embedding {len(texts)} documents...")
             start_time = time.time()
@@ -65,7 +95,54 @@ class LoggingEmbeddingsDecorator(Embeddings):
             return self.delegate.embed_documents(texts)
 
     def embed_query(self, text: str) -> List[float]:
-        return self.embed_documents([text])[0]
+        if self.query_cache is None:
+            return self.embed_documents([text])[0]
+
+        result = self.query_cache.get(text)
+        if result is None:
+            result = self.embed_documents([text])[0]
+            self.query_cache.put(text, result)
+        logger.debug(f"Query embedding cache: {self.query_cache.stats()}")
+        return result
+
+
+def get_embedding_model_name(embedding_provider: str) -> str:
+    if embedding_provider == "openai":
+        return get_env('OPENAI_EMBEDDING_MODEL')
+    elif embedding_provider == "azure":
+        return get_env('AZURE_EMBEDDING_MODEL')
+    elif embedding_provider == "local":
+        return f"tfidf-svd-{get_local_embeddings().model_id}"
+    else:
+        raise ValueError(f"Unknown embedding model: {embedding_provider}")
+
+
+def get_embedding_namespace(embedding_provider: str) -> str:
+    return f"{embedding_provider}/{get_embedding_model_name(embedding_provider)}"
+
+
+def create_embedding_cache(embedding_provider: str) -> EmbeddingCache:
+    max_size_mb = int(get_env('EMBEDDING_CACHE_MAX_MB') or DEFAULT_MAX_CACHE_SIZE_MB)
+    return EmbeddingCache(EMBEDDING_CACHE_FILE,
+                          namespace=get_embedding_namespace(embedding_provider),
+                          max_size_bytes=max_size_mb * 1024 * 1024)
+
+
+def create_query_embedding_cache(embedding_provider: str) -> QueryEmbeddingCache:
+    ttl_seconds = get_env('QUERY_EMBEDDING_CACHE_TTL_SECONDS')
+    return QueryEmbeddingCache(get_embedding_namespace(embedding_provider),
+                               max_entries=int(get_env('QUERY_EMBEDDING_CACHE_SIZE') or DEFAULT_MAX_QUERY_CACHE_ENTRIES),
+                               ttl_seconds=float(ttl_seconds) if ttl_seconds else None)
+
+
+@lru_cache(maxsize=None)
+def get_local_embeddings() -> LocalEmbeddings:
+    return LocalEmbeddings.load_or_fit(LOCAL_EMBEDDING_MODEL_FILE, PATIENT_REPORTS_TXT,
+                                       dimensions=int(get_env('LOCAL_EMBEDDING_DIMENSIONS') or DEFAULT_LOCAL_EMBEDDING_DIMENSIONS))
+
+
+def get_embedding_batch_size(embedding_provider: str) -> int:
+    return NR_OF_DOCS_TO_EMBED_LOCALLY_AT_ONCE if embedding_provider == "local" else NR_OF_DOCS_TO_EMBED_AT_ONCE
 
 
 def create_embedding_function(embedding_provider: str):
@@ -83,7 +160,8 @@ def create_embedding_function(embedding_provider: str):
         """
         return OpenAIEmbeddings(
             model=model,
-            max_retries=5,
+            openai_api_base=get_env('OPENAI_EMBEDDING_BASE_URL'),  # Optional, e.g. a local fake endpoint for testing
+            max_retries=0,  # Rate limited requests are retried by the ingestion (with an adaptive concurrency)
             show_progress_bar=True,
             chunk_size=NR_OF_DOCS_TO_EMBED_AT_ONCE,
             embedding_ctx_length=8191  # Max. tokens in a single document
@@ -94,35 +172,52 @@ def create_embedding_function(embedding_provider: str):
             api_version=get_env('AZURE_API_VERSION'),
             azure_deployment=get_env('AZURE_EMBEDDING_MODEL'),
             api_key=get_env('AZURE_API_KEY'),
-            max_retries=5,
+            max_retries=0,
             chunk_size=NR_OF_DOCS_TO_EMBED_AT_ONCE,
         )
+    elif embedding_provider == "local":
+        return get_local_embeddings()
     else:
         raise ValueError(f"Unknown embedding model: {embedding_provider}")
 
 
-def init_chroma_db(total_patient_count: int) -> Chroma:
+def delete_documents(db: Chroma, doc_ids: Set[str]):
+    doc_ids = list(doc_ids)
+    for i in range(0, len(doc_ids), NR_OF_DOCS_TO_DELETE_AT_ONCE):
+        db.delete(ids=doc_ids[i:i + NR_OF_DOCS_TO_DELETE_AT_ONCE])
+    logger.info(f"Deleted {len(doc_ids)} outdated documents from the Chroma DB")
+
+
+def init_chroma_db(total_patient_count: int, doc_ids_to_delete: Set[str] = frozenset()) -> Chroma:
+    embedding_provider = get_env('EMBEDDING_PROVIDER')
     db = Chroma(
-        embedding_function=LoggingEmbeddingsDecorator(create_embedding_function(get_env('EMBEDDING_PROVIDER'))),
+        # Local embeddings are cheaper to compute than to look up in the persistent cache
+        embedding_function=LoggingEmbeddingsDecorator(create_embedding_function(embedding_provider),
+                                                      cache=create_embedding_cache(embedding_provider)
+                                                      if embedding_provider != "local" else None,
+                                                      query_cache=create_query_embedding_cache(embedding_provider)),
         persist_directory=CHROMA_PERSIST_DIR)
 
     try:
-        already_embedded_doc_ids = set(db.get()['ids'])
+        # Removed or changed patient journeys are deleted first, changed ones are then re-embedded below
+        if doc_ids_to_delete:
+            delete_documents(db, doc_ids_to_delete)
+
+        already_embedded_doc_ids = set(db.get(include=[])['ids'])
         if len(already_embedded_doc_ids) != total_patient_count:
             docs = create_documents(PATIENT_REPORTS_TXT, already_embedded_doc_ids)
             logger.info(f"{len(docs)} new documents need to be embedded and added to the Chroma DB")
-            for i in range(0, len(docs), NR_OF_DOCS_TO_EMBED_AT_ONCE):
-                docs_to_embed = docs[i:i + NR_OF_DOCS_TO_EMBED_AT_ONCE]
-                logger.debug(f"Submitting chunk of {len(docs_to_embed)} new documents to the embedding function")
-                ids = list(map(lambda d: d.metadata[PID_METADATA_FIELD_NAME], docs_to_embed))
-                db.add_documents(docs_to_embed, ids=ids)
-                db.persist()
-                logger.info(f"Added chunk of {len(docs_to_embed)} new embedded documents to the Chroma DB")
+            ids = [doc.metadata[PID_METADATA_FIELD_NAME] for doc in docs]
+            ingest_documents(db, docs, ids,
+                             batch_size=get_embedding_batch_size(embedding_provider),
+                             max_in_flight=int(get_env('EMBEDDING_MAX_IN_FLIGHT') or DEFAULT_MAX_IN_FLIGHT))
             logger.info(f"Added total of {len(docs)} new documents to the Chroma DB")
         else:
             logger.info('All documents already existing in the Chroma DB')
     except Exception as e:
+        # Raised, so the data hash & manifest aren't updated and the (incremental) refresh is repeated on the next run
         logger.error(f"Error while embedding documents into Chroma DB: {e}")
+        raise
     finally:
         db.persist()
 
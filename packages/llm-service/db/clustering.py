@@ -1,12 +1,19 @@
 import logging
+import os
+from typing import Set, Optional, Dict, Tuple, Union
 
+import joblib
 import numpy as np
 import pandas as pd
 import umap as umap_lib
 from langchain_community.vectorstores import Chroma
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.decomposition import PCA
+from sklearn.pipeline import Pipeline, make_pipeline
 
+from db.data_dir_contents import CLUSTERING_MODEL_FILE, CLUSTERING_REFIT_FILE
 from db.shared import COORDINATES_AND_CLUSTER_COLUMN_NAMES
+from utils.get_env import get_env
 
 logger = logging.getLogger(__name__)
 
@@ -17,48 +24,243 @@ UMAP_N_NEIGHBORS = 9
 UMAP_MIN_DIST = 0.011
 UMAP_METRIC = 'cosine'
 
+# - exact: UMAP on the full embeddings & K-Means, reproducible (the fixed seed makes UMAP single-threaded)
+# - large: PCA pre-reduction (float32), UMAP with approximate nearest neighbours on all cores (not reproducible)
+#   & mini-batch K-Means, for 100k+ patients
+CLUSTERING_PIPELINES = ['exact', 'large']
+DEFAULT_CLUSTERING_PIPELINE = 'exact'
+DEFAULT_PCA_N_DIMENSIONS = 50
+MINI_BATCH_SIZE = 4096
+
+# The map & clusters are refitted from scratch once the placed (not fitted) patients exceed this share of all patients,
+# or once they are this much farther from their cluster centroids than the fitted ones
+MAX_PLACED_RATIO = 0.5
+MAX_CENTROID_DISTANCE_RATIO = 1.5
+
+
+class ClusteringModel:
+    """
+    The fitted UMAP reducer & K-Means model, persisted to place new patients into the existing 2D map & clusters.
+    The mean distance of the fitted patients to their cluster centroid is kept as reference for the drift metric.
+    """
+
+    def __init__(self, reducer: Union[umap_lib.UMAP, Pipeline], kmeans: Union[KMeans, MiniBatchKMeans], fitted_pids: Set[str], fitted_centroid_distance: float):
+        self.reducer = reducer
+        self.kmeans = kmeans
+        self.fitted_pids = fitted_pids
+        self.fitted_centroid_distance = fitted_centroid_distance
+
+    def save(self):
+        # Write to a temporary file first, so an interrupted run never leaves a truncated model behind
+        temporary_path = CLUSTERING_MODEL_FILE + '.tmp'
+        joblib.dump(self, temporary_path)
+        os.replace(temporary_path, CLUSTERING_MODEL_FILE)
+
+    def mean_centroid_distance(self, coordinates: np.ndarray) -> float:
+        distances = self.kmeans.transform(coordinates.astype(self.kmeans.cluster_centers_.dtype))
+        return float(np.min(distances, axis=1).mean())
+
+
+def get_clustering_pipeline() -> str:
+    pipeline = get_env('CLUSTERING_PIPELINE') or DEFAULT_CLUSTERING_PIPELINE
+    if pipeline not in CLUSTERING_PIPELINES:
+        raise ValueError(f"Invalid clustering pipeline: {pipeline}")
+    return pipeline
+
+
+def load_clustering_model() -> Optional[ClusteringModel]:
+    if not os.path.exists(CLUSTERING_MODEL_FILE):
+        return None
+    return joblib.load(CLUSTERING_MODEL_FILE)
+
 
 def calc_2d_and_clusters(db: Chroma) -> pd.DataFrame:
-    logger.info("Dimensionality Reduction & Clustering")
+    pipeline = get_clustering_pipeline()
+    logger.info(f"Dimensionality Reduction & Clustering ({pipeline} pipeline)")
 
-    entries = db.get(include=['embeddings', 'documents'])
+    entries = db.get(include=['embeddings'])
     ids, embeddings = entries['ids'], entries['embeddings']
-    coordinates = reduce_dimensionality(embeddings)
-    clusters = create_clusters(coordinates)
-    coordinates_and_clusters = []
-    for index, id in enumerate(ids):
-        coordinates_and_clusters.append(
-            [id, float(coordinates[index][0]), float(coordinates[index][1]), int(clusters[index])])
-
-    # Read into a neatly named data frame
-    df = pd.DataFrame(coordinates_and_clusters)
-    df = df.drop(df.columns[0], axis=1)
-    df.columns = COORDINATES_AND_CLUSTER_COLUMN_NAMES
+    reducer, coordinates = reduce_dimensionality(embeddings, pipeline)
+    kmeans, clusters = create_clusters(coordinates, pipeline)
+
+    # Persist the fitted models, so later added or changed patients are placed without refitting
+    model = ClusteringModel(reducer, kmeans, set(ids), 0.0)
+    model.fitted_centroid_distance = model.mean_centroid_distance(coordinates)
+    model.save()
+
+    # Read into a neatly named data frame (indexed by patient ID, since Chroma does not preserve the patient order)
+    df = pd.DataFrame({
+        COORDINATES_AND_CLUSTER_COLUMN_NAMES[0]: coordinates[:, 0].astype(float),
+        COORDINATES_AND_CLUSTER_COLUMN_NAMES[1]: coordinates[:, 1].astype(float),
+        COORDINATES_AND_CLUSTER_COLUMN_NAMES[2]: clusters.astype(int),
+    }, index=pd.Index(ids))
 
     return df
 
 
-def reduce_dimensionality(embeddings: list[list[float]]):
+def place_patients(db: Chroma, placed_df: pd.DataFrame, pids_to_place: Set[str]) -> pd.DataFrame:
+    """
+    Places patients into the existing 2D map & clusters without refitting them: via the persisted models if available,
+    otherwise relative to their nearest already placed neighbours.
+    """
+    model = load_clustering_model()
+    if model is None:
+        return place_patients_by_neighbors(db, placed_df, pids_to_place)
+
+    logger.info(f"Placing {len(pids_to_place)} patients into the existing 2D map & clusters (UMAP transform)")
+    entries = db.get(ids=list(pids_to_place), include=['embeddings'])
+    coordinates = model.reducer.transform(np.array(entries['embeddings']))
+    # K-Means only predicts coordinates of the dtype it was fitted on
+    clusters = model.kmeans.predict(coordinates.astype(model.kmeans.cluster_centers_.dtype))
+
+    # Changed patients are no longer the ones the models were fitted on, so they count as placed for the drift
+    if model.fitted_pids & pids_to_place:
+        model.fitted_pids -= pids_to_place
+        model.save()
+
+    return pd.DataFrame({
+        COORDINATES_AND_CLUSTER_COLUMN_NAMES[0]: coordinates[:, 0].astype(float),
+        COORDINATES_AND_CLUSTER_COLUMN_NAMES[1]: coordinates[:, 1].astype(float),
+        COORDINATES_AND_CLUSTER_COLUMN_NAMES[2]: clusters.astype(int),
+    }, index=pd.Index(entries['ids']))
+
+
+def calc_drift(coordinates_and_clusters_df: pd.DataFrame) -> Optional[Dict[str, float]]:
+    """
+    Compares the current patients with the ones the models were fitted on:
+    - placed_ratio: Share of the patients which were placed (not fitted)
+    - centroid_distance_ratio: Mean distance of the placed patients to their nearest centroid, relative to the fitted ones
+    """
+    model = load_clustering_model()
+    if model is None or coordinates_and_clusters_df.empty:
+        return None
+
+    placed_df = coordinates_and_clusters_df[~coordinates_and_clusters_df.index.isin(model.fitted_pids)]
+    centroid_distance_ratio = 1.0
+    if not placed_df.empty:
+        placed_distance = model.mean_centroid_distance(placed_df[COORDINATES_AND_CLUSTER_COLUMN_NAMES[:2]].to_numpy())
+        centroid_distance_ratio = placed_distance / max(model.fitted_centroid_distance, 1e-12)
+    return {
+        'placed_ratio': len(placed_df) / len(coordinates_and_clusters_df),
+        'centroid_distance_ratio': centroid_distance_ratio,
+    }
+
+
+def is_refit_needed(drift: Optional[Dict[str, float]]) -> bool:
+    if drift is None:
+        return False
+    logger.info(f"Clustering drift: {drift['placed_ratio']:.1%} of the patients placed since the last fit, "
+                f"centroid distance ratio {drift['centroid_distance_ratio']:.2f}")
+    return drift['placed_ratio'] > MAX_PLACED_RATIO or drift['centroid_distance_ratio'] > MAX_CENTROID_DISTANCE_RATIO
+
+
+def get_refit_token() -> Optional[str]:
+    token = (get_env('CLUSTERING_REFIT') or '').strip()
+    return token if token and token.lower() != 'false' else None
+
+
+def read_refit_token() -> Optional[str]:
+    if not os.path.exists(CLUSTERING_REFIT_FILE):
+        return None
+    with open(CLUSTERING_REFIT_FILE, 'r') as file:
+        return file.read().strip()
+
+
+def is_refit_requested() -> bool:
+    # A refit is requested once per value of CLUSTERING_REFIT: The value of the last requested refit is stored, so the
+    # map is not refitted on every start while the variable is set (set another value to request the next refit)
+    token = get_refit_token()
+    return token is not None and token != read_refit_token()
+
+
+def save_refit_token():
+    token = get_refit_token()
+    if token is None:
+        return
+    temporary_path = CLUSTERING_REFIT_FILE + '.tmp'
+    with open(temporary_path, 'w') as file:
+        file.write(token)
+    os.replace(temporary_path, CLUSTERING_REFIT_FILE)
+
+
+def place_patients_by_neighbors(db: Chroma, placed_df: pd.DataFrame, pids_to_place: Set[str]) -> pd.DataFrame:
+    """
+    Places patients into an existing 2D map without refitting it:
+    Each patient gets the mean coordinates of its nearest (cosine) already placed neighbours and their most common cluster.
+    """
+    logger.info(f"Placing {len(pids_to_place)} patients into the existing 2D map & clusters (nearest neighbours)")
+
+    placed_pids = placed_df.index.tolist()
+    pids_to_place = list(pids_to_place)
+    placed_entries = db.get(ids=placed_pids, include=['embeddings'])
+    # Chroma returns the entries in its own order, so the placed coordinates are aligned to it
+    placed_df = placed_df.loc[placed_entries['ids']]
+    placed_embeddings = normalize(np.array(placed_entries['embeddings']))
+    entries = db.get(ids=pids_to_place, include=['embeddings'])
+    new_embeddings = normalize(np.array(entries['embeddings']))
+
+    n_neighbors = min(UMAP_N_NEIGHBORS, len(placed_df))
+    similarities = new_embeddings @ placed_embeddings.T
+    neighbor_indices = np.argpartition(-similarities, n_neighbors - 1, axis=1)[:, :n_neighbors]
+
+    x_column, y_column, cluster_column = COORDINATES_AND_CLUSTER_COLUMN_NAMES
+    coordinates = placed_df[[x_column, y_column]].to_numpy()[neighbor_indices].mean(axis=1)
+    neighbor_clusters = placed_df[cluster_column].to_numpy()[neighbor_indices]
+    clusters = [np.bincount(row).argmax() for row in neighbor_clusters]
+
+    return pd.DataFrame({
+        x_column: coordinates[:, 0],
+        y_column: coordinates[:, 1],
+        cluster_column: clusters,
+    }, index=pd.Index(entries['ids']))
+
+
+def normalize(embeddings: np.ndarray) -> np.ndarray:
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+
+def reduce_dimensionality(embeddings: list[list[float]], pipeline: str = DEFAULT_CLUSTERING_PIPELINE) \
+        -> Tuple[Union[umap_lib.UMAP, Pipeline], np.ndarray]:
     logger.info("  -> Reducing dimensions via UMAP...")
-    embeddings = np.array(embeddings)
+    embeddings = np.array(embeddings, dtype=np.float32 if pipeline == 'large' else None)
     n_samples = embeddings.shape[0]  # Number of samples
 
     if n_samples < 2:
         raise ValueError('Number of samples must be greater than 1')
 
+    if pipeline == 'exact':
+        umap = umap_lib.UMAP(
+            n_components=TARGET_N_DIMENSIONS,
+            random_state=RANDOM_STATE,
+            n_neighbors=UMAP_N_NEIGHBORS,
+            min_dist=UMAP_MIN_DIST,
+            metric=UMAP_METRIC
+        )
+        return umap, umap.fit_transform(embeddings)
+
+    # The PCA keeps the (cosine) neighbourhoods largely intact, but makes the neighbour search a lot cheaper
+    pca_n_dimensions = int(get_env('CLUSTERING_PCA_DIMENSIONS') or DEFAULT_PCA_N_DIMENSIONS)
+    pca = PCA(n_components=min(pca_n_dimensions, *embeddings.shape), svd_solver='randomized', random_state=RANDOM_STATE)
     umap = umap_lib.UMAP(
         n_components=TARGET_N_DIMENSIONS,
-        random_state=RANDOM_STATE,
         n_neighbors=UMAP_N_NEIGHBORS,
         min_dist=UMAP_MIN_DIST,
-        metric=UMAP_METRIC
+        metric=UMAP_METRIC,
+        n_jobs=-1,
+        low_memory=True,
+        force_approximation_algorithm=True
     )
-    return umap.fit_transform(embeddings)
+    reducer = make_pipeline(pca, umap)
+    return reducer, reducer.fit_transform(embeddings)
 
 
-def create_clusters(reduced_embeddings: np.ndarray):
+def create_clusters(reduced_embeddings: np.ndarray, pipeline: str = DEFAULT_CLUSTERING_PIPELINE) \
+        -> Tuple[Union[KMeans, MiniBatchKMeans], np.ndarray]:
     logger.info("  -> Clustering via K-Means...")
     n_samples = reduced_embeddings.shape[0]
     n_clusters = min(CLUSTER_COUNT, max(n_samples, 1))
-    kmeans = KMeans(n_clusters=n_clusters, random_state=RANDOM_STATE)
-    return kmeans.fit_predict(reduced_embeddings)
+    if pipeline == 'exact':
+        kmeans = KMeans(n_clusters=n_clusters, random_state=RANDOM_STATE)
+    else:
+        kmeans = MiniBatchKMeans(n_clusters=n_clusters, random_state=RANDOM_STATE, batch_size=MINI_BATCH_SIZE)
+    return kmeans, kmeans.fit_predict(reduced_embeddings)
@@ -0,0 +1,144 @@
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Dict, Optional
+
+import numpy as np
+import pandas as pd
+import umap as umap_lib
+from sklearn.cluster import KMeans
+from sklearn.decomposition import PCA
+
+from db.clustering import CLUSTER_COUNT, RANDOM_STATE, TARGET_N_DIMENSIONS, UMAP_N_NEIGHBORS, UMAP_MIN_DIST, \
+    UMAP_METRIC
+from db.embedding_matrix import EmbeddingMatrix
+from db.shared import COORDINATES_AND_CLUSTER_COLUMN_NAMES
+
+# Re-clustering of a user-selected cohort (instead of the frozen 2D map & clusters of the whole population):
+# The cohort is selected by row indices from the memory-mapped float32 embedding matrix (instead of a Chroma lookup),
+# reduced via PCA, laid out via a shortened UMAP run & clustered via K-Means. Results are cached per cohort (hash of the
+# sorted PIDs). The duration per cohort size is measured by utils/benchmark_cohort_clustering.py.
+# The numba functions of UMAP are compiled on the first run (~30 seconds), so the clustering is warmed up at startup.
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_COHORT_CLUSTERING_CACHE_SIZE = 64
+
+# The cohort embeddings are reduced to this many dimensions before UMAP, which makes the neighbour search cheap
+COHORT_PCA_N_DIMENSIONS = 50
+
+# Fewer optimization epochs than the default (500 for data sets of up to 10,000 samples, 200 for larger ones) keep the
+# layout fast. The PCA initialization (instead of a spectral one) starts from a layout that needs fewer epochs to settle.
+COHORT_UMAP_N_EPOCHS = 100
+
+# Size of the cohort clustered to warm up (compile) UMAP. The approximate neighbour search is used for all cohort sizes,
+# so any cohort (with more patients than neighbours) compiles the same code paths.
+WARM_UP_COHORT_SIZE = 100
+
+
+def create_cohort_key(pids: List[str]) -> str:
+    return hashlib.sha256('\n'.join(pids).encode('utf-8')).hexdigest()
+
+
+def cluster_cohort(vectors: np.ndarray) -> np.ndarray:
+    """Returns the 2D coordinates & the cluster of each row, as array of shape (n, 3)."""
+    n_samples = vectors.shape[0]
+    reduced = PCA(n_components=min(COHORT_PCA_N_DIMENSIONS, *vectors.shape), random_state=RANDOM_STATE) \
+        .fit_transform(vectors)
+    if n_samples > UMAP_N_NEIGHBORS:
+        coordinates = umap_lib.UMAP(
+            n_components=TARGET_N_DIMENSIONS,
+            random_state=RANDOM_STATE,
+            n_neighbors=UMAP_N_NEIGHBORS,
+            min_dist=UMAP_MIN_DIST,
+            metric=UMAP_METRIC,
+            n_epochs=COHORT_UMAP_N_EPOCHS,
+            init='pca',
+            # The exact neighbour search (used by default for fewer than 4096 samples) computes the distances via a
+            # Python callback per pair, which takes seconds for a few thousand patients
+            force_approximation_algorithm=True
+        ).fit_transform(reduced)
+    else:
+        # Too few patients for a neighbourhood graph, the principal components are the layout
+        coordinates = np.zeros((n_samples, TARGET_N_DIMENSIONS), dtype=np.float32)
+        coordinates[:, :reduced.shape[1]] = reduced[:, :TARGET_N_DIMENSIONS]
+
+    kmeans = KMeans(n_clusters=min(CLUSTER_COUNT, n_samples), random_state=RANDOM_STATE, n_init=1)
+    clusters = kmeans.fit_predict(coordinates)
+    return np.column_stack([coordinates, clusters])
+
+
+class CohortClustering:
+    """Clusters cohorts on the embedding matrix, the results are kept in an LRU cache (by cohort)."""
+
+    def __init__(self, matrix: EmbeddingMatrix, cache_size: int = DEFAULT_COHORT_CLUSTERING_CACHE_SIZE):
+        self.matrix = matrix
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self.entries: OrderedDict[str, pd.DataFrame] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_cached(self, key: str) -> Optional[pd.DataFrame]:
+        with self.lock:
+            df = self.entries.get(key)
+            if df is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return df
+
+    def put(self, key: str, df: pd.DataFrame):
+        with self.lock:
+            self.entries[key] = df
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.cache_size:
+                self.entries.popitem(last=False)
+
+    def warm_up(self):
+        """Clusters the first patients of the matrix (not cached), which compiles the numba functions of UMAP."""
+        if len(self.matrix.pids) < 2:
+            return
+        start_time = time.time()
+        cluster_cohort(np.asarray(self.matrix.vectors[:WARM_UP_COHORT_SIZE]))
+        logger.info(f"Cohort clustering has been warmed up in {time.time() - start_time:.1f} seconds")
+
+    def cluster(self, pids: List[str]) -> pd.DataFrame:
+        """
+        Returns the 2D coordinates & clusters of the given patients (indexed by patient ID).
+        Patients without an embedding are left out, at least two patients must remain.
+        """
+        cohort_pids = sorted({pid for pid in pids if pid in self.matrix.pid_indices})
+        if len(cohort_pids) < 2:
+            raise ValueError('At least two known patients are needed to cluster a cohort')
+
+        key = create_cohort_key(cohort_pids)
+        df = self.get_cached(key)
+        if df is not None:
+            return df
+
+        start_time = time.time()
+        rows = np.fromiter((self.matrix.pid_indices[pid] for pid in cohort_pids), dtype=np.int64, count=len(cohort_pids))
+        result = cluster_cohort(self.matrix.vectors[rows])
+        df = pd.DataFrame({
+            COORDINATES_AND_CLUSTER_COLUMN_NAMES[0]: result[:, 0].astype(float),
+            COORDINATES_AND_CLUSTER_COLUMN_NAMES[1]: result[:, 1].astype(float),
+            COORDINATES_AND_CLUSTER_COLUMN_NAMES[2]: result[:, 2].astype(int),
+        }, index=pd.Index(cohort_pids))
+        logger.info(f"Clustered a cohort of {len(cohort_pids)} patients in {(time.time() - start_time) * 1000:.0f} ms")
+
+        self.put(key, df)
+        return df
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': len(self.entries),
+            }
@@ -0,0 +1,52 @@
+import logging
+import os
+from typing import Optional
+
+import pandas as pd
+
+from db.data_dir_contents import EVENTS_ARROW
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc as ipc
+except ImportError:  # The columnar export is optional, CSV is always available
+    pa = None
+
+# Exports the events as an Arrow IPC file, so clients can load them without parsing CSV.
+# The hash of the source CSV is stored in the schema metadata to detect outdated exports.
+
+logger = logging.getLogger(__name__)
+
+ARROW_MEDIA_TYPE = 'application/vnd.apache.arrow.file'
+SOURCE_HASH_METADATA_KEY = b'source_hash'
+
+
+def read_source_hash(file_path: str) -> Optional[str]:
+    try:
+        with pa.memory_map(file_path) as source:
+            metadata = ipc.open_file(source).schema.metadata or {}
+            return metadata.get(SOURCE_HASH_METADATA_KEY, b'').decode() or None
+    except (OSError, pa.ArrowInvalid):
+        return None
+
+
+def init_events_arrow(events_df: pd.DataFrame, source_hash: str) -> Optional[str]:
+    if pa is None:
+        logger.info("pyarrow is not installed, events are only available as CSV")
+        return None
+
+    if os.path.exists(EVENTS_ARROW) and read_source_hash(EVENTS_ARROW) == source_hash:
+        logger.info(f"Columnar events file {EVENTS_ARROW} is up to date")
+        return EVENTS_ARROW
+
+    table = pa.Table.from_pandas(events_df, preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), SOURCE_HASH_METADATA_KEY: source_hash.encode()})
+
+    # Write to a temporary file first, so an interrupted run never leaves a truncated export behind
+    temporary_path = EVENTS_ARROW + '.tmp'
+    with pa.OSFile(temporary_path, 'wb') as sink, ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    os.replace(temporary_path, EVENTS_ARROW)
+
+    logger.info(f"Columnar events file has been written to {EVENTS_ARROW}")
+    return EVENTS_ARROW
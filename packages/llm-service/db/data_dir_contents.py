@@ -15,5 +15,17 @@ PATIENTS_CSV = f('patients.csv')
 EVENTS_CSV = f('events.csv')
 PATIENT_REPORTS_TXT = f('patient_reports.txt')
 HASH_FILE = f('hash.txt')
+MANIFEST_FILE = f('manifest.json')
 SQLITE_DB_FILE = f('data.db')
+SCHEMA_FILE = f('schema.txt')
+EVENTS_ARROW = f('events.arrow')
+HTTP_CACHE_DIR = f('http-cache')
 CHROMA_PERSIST_DIR = f('chroma-persist')
+EMBEDDING_CACHE_FILE = f('embedding-cache.sqlite3')
+BM25_INDEX_FILE = f('bm25-index.npz')
+LOCAL_EMBEDDING_MODEL_FILE = f('local-embedding-model.joblib')
+CLUSTERING_MODEL_FILE = f('clustering-model.joblib')
+CLUSTERING_REFIT_FILE = f('clustering-refit.txt')
+EMBEDDING_MATRIX_FILE = f('embedding-matrix.npy')
+EMBEDDING_MATRIX_META_FILE = f('embedding-matrix.json')
+INIT_LOCK_FILE = f('init.lock')
@@ -1,4 +1,5 @@
 import logging
+from typing import Optional
 
 import pandas as pd
 
@@ -24,35 +25,47 @@ HEADER_ROW_COUNT = 2  # column name row + column type row
 PATIENT_ID_COLUMN_NAME = 'Patient ID'
 EVENT_ID_COLUMN_NAME = 'Event ID'
 
+# The PJ column types (pid, category, timestamp, ...) are kept in the data frame attrs under this key
+COLUMN_TYPES_ATTR = 'pj_column_types'
 
-def find_duplicate_ids(ids):
-    sorted_ids = sorted(ids)
-    duplicate_ids = []
-    for i in range(len(sorted_ids) - 1):
-        if sorted_ids[i] == sorted_ids[i + 1]:
-            duplicate_ids.append(sorted_ids[i])
-    return duplicate_ids
 
+# Limits the number of offending IDs listed in consistency errors (None lists all of them)
+MAX_LISTED_INVALID_IDS = 100
 
-def find_non_matching_id_refs(known_ids, id_refs):
-    return list({id_ref for id_ref in id_refs if id_ref not in known_ids})
 
+def find_duplicate_ids(ids: pd.Series) -> list:
+    # Every occurrence after the first one is a duplicate (same as comparing sorted neighbours)
+    return ids[ids.duplicated()].sort_values().tolist()
 
-def check_data_consistency(patient_data, event_data):
-    pids = patient_data[PATIENT_ID_COLUMN_NAME].tolist()
+
+def find_non_matching_id_refs(known_ids: pd.Series, id_refs: pd.Series) -> list:
+    return id_refs[~id_refs.isin(known_ids)].unique().tolist()
+
+
+def format_ids(ids: list, max_listed_ids: Optional[int]) -> str:
+    if max_listed_ids is None or len(ids) <= max_listed_ids:
+        return f"{ids}"
+    return f"{ids[:max_listed_ids]} (and {len(ids) - max_listed_ids} more)"
+
+
+def check_data_consistency(patient_data, event_data, max_listed_ids: Optional[int] = MAX_LISTED_INVALID_IDS):
+    pids = patient_data[PATIENT_ID_COLUMN_NAME]
     duplicate_patient_ids = find_duplicate_ids(pids)
     if duplicate_patient_ids:
-        raise ValueError(f"Patient data table contains non-unique pid values: {duplicate_patient_ids}")
+        raise ValueError(
+            f"Patient data table contains non-unique pid values: {format_ids(duplicate_patient_ids, max_listed_ids)}")
 
-    eids = event_data[EVENT_ID_COLUMN_NAME].tolist()
+    eids = event_data[EVENT_ID_COLUMN_NAME]
     duplicate_event_ids = find_duplicate_ids(eids)
     if duplicate_event_ids:
-        raise ValueError(f"Event data table contains non-unique eid values: {duplicate_event_ids}")
+        raise ValueError(
+            f"Event data table contains non-unique eid values: {format_ids(duplicate_event_ids, max_listed_ids)}")
 
-    pid_refs = event_data[PATIENT_ID_COLUMN_NAME].tolist()
-    non_matching_pid_refs = find_non_matching_id_refs(set(pids), pid_refs)
+    pid_refs = event_data[PATIENT_ID_COLUMN_NAME]
+    non_matching_pid_refs = find_non_matching_id_refs(pids, pid_refs)
     if non_matching_pid_refs:
-        raise ValueError(f"Event data table contains invalid pid references: {non_matching_pid_refs}")
+        raise ValueError(
+            f"Event data table contains invalid pid references: {format_ids(non_matching_pid_refs, max_listed_ids)}")
 
 
 def load_data_frames() -> LoadedDataFrames:
@@ -78,6 +91,7 @@ def load_df(file_path: str) -> pd.DataFrame:
         column_type = column_headers_df.iloc[0][column_name]
         if column_type == 'date':
             date_columns.append(column_name)
+            dtype_dict[column_name] = str
         if column_type in COLUMN_TYPE_MAPPING:
             dtype_dict[column_name] = COLUMN_TYPE_MAPPING[column_type]
         if column_type == 'pid':
@@ -96,16 +110,34 @@ def load_df(file_path: str) -> pd.DataFrame:
 
     # Convert date columns and report any format errors
     for date_column in date_columns:
-        for i, date_value in enumerate(df[date_column]):
-            try:
-                pd.to_datetime(date_value, format=DATE_FORMAT, errors='raise')
-            except ValueError:
-                row_number = i + HEADER_ROW_COUNT + 1
-                logger.error(
-                    f"File {file_path}: Error parsing date at row {row_number}, column '{date_column}': {date_value}")
+        date_values = df[date_column]
+        parsed_dates = pd.to_datetime(date_values, format=DATE_FORMAT, errors='coerce')
+
+        # Values that were present but could not be parsed are coerced to NaT
+        for i in (parsed_dates.isna() & date_values.notna()).to_numpy().nonzero()[0]:
+            row_number = i + HEADER_ROW_COUNT + 1
+            logger.error(
+                f"File {file_path}: Error parsing date at row {row_number}, column '{date_column}': {date_values.iat[i]}")
+
+        # Keep the parsed dates, so later stages don't need to parse them again
+        # (before rendering the patient journeys or writing to the SQLite database, format_dates turns them back into
+        # DATE_FORMAT text)
+        df[date_column] = parsed_dates
+
+    df.attrs[COLUMN_TYPES_ATTR] = {rename_dict.get(column_name, column_name): column_type
+                                   for column_name, column_type in column_headers_df.iloc[0].items()}
 
     return df
 
 
+def format_dates(df: pd.DataFrame) -> pd.DataFrame:
+    # Date columns are rendered & stored as text in DATE_FORMAT (the same format as in the input files), as they were
+    # before load_df kept the parsed dates. Unparsable dates (NaT) are treated like missing ones.
+    date_columns = df.select_dtypes(include='datetime').columns
+    if date_columns.empty:
+        return df
+    return df.assign(**{column: df[column].dt.strftime(DATE_FORMAT) for column in date_columns})
+
+
 def concat_coordinates_and_cluster_to_patients(patients_df: pd.DataFrame, coordinates_and_clusters_df: pd.DataFrame) -> pd.DataFrame:
     return pd.concat([patients_df, coordinates_and_clusters_df], axis=1)
@@ -0,0 +1,161 @@
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional, Dict, Tuple
+
+import numpy as np
+
+# Persistent, content-addressed cache for document embeddings.
+# Vectors are stored as float32 blobs in a SQLite file, keyed by (provider/model namespace, SHA-256 of the text).
+# This way, wiping the Chroma DB only requires re-embedding texts that actually changed.
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_CACHE_SIZE_MB = 1024
+
+DEFAULT_MAX_QUERY_CACHE_ENTRIES = 1024
+
+# When the cache exceeds its maximum size, least recently used entries are evicted down to this fraction
+EVICTION_TARGET_RATIO = 0.9
+
+
+def hash_text(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    def __init__(self, file_path: str, namespace: str, max_size_bytes: int = DEFAULT_MAX_CACHE_SIZE_MB * 1024 * 1024):
+        self.namespace = namespace
+        self.max_size_bytes = max_size_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        # Embeddings are requested from several ingestion threads, access is serialized through the lock
+        self.conn = sqlite3.connect(file_path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                namespace TEXT NOT NULL,
+                text_hash TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (namespace, text_hash)
+            )""")
+        self.conn.execute('CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)')
+        self.conn.commit()
+        self.size_bytes = self.conn.execute('SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings').fetchone()[0]
+
+    def get_many(self, texts: List[str]) -> List[Optional[List[float]]]:
+        hashes = [hash_text(text) for text in texts]
+        found: Dict[str, bytes] = {}
+        with self.lock:
+            # Stay well below SQLite's limit of host parameters per statement
+            for i in range(0, len(hashes), 500):
+                batch = hashes[i:i + 500]
+                placeholders = ', '.join('?' * len(batch))
+                rows = self.conn.execute(
+                    f'SELECT text_hash, vector FROM embeddings WHERE namespace = ? AND text_hash IN ({placeholders})',
+                    [self.namespace, *batch])
+                found.update(rows)
+            if found:
+                now = time.time()
+                self.conn.executemany('UPDATE embeddings SET last_used = ? WHERE namespace = ? AND text_hash = ?',
+                                      [(now, self.namespace, h) for h in found])
+                self.conn.commit()
+            self.hits += sum(1 for h in hashes if h in found)
+            self.misses += sum(1 for h in hashes if h not in found)
+        return [np.frombuffer(found[h], dtype=np.float32).tolist() if h in found else None for h in hashes]
+
+    def put_many(self, texts: List[str], vectors: List[List[float]]):
+        now = time.time()
+        # Deduplicate by hash, so the size bookkeeping matches what is actually stored
+        rows = list({hash_text(text): (self.namespace, hash_text(text), np.asarray(vector, dtype=np.float32).tobytes(), now)
+                     for text, vector in zip(texts, vectors)}.values())
+        with self.lock:
+            for row in rows:
+                replaced = self.conn.execute('SELECT LENGTH(vector) FROM embeddings WHERE namespace = ? AND text_hash = ?',
+                                             row[:2]).fetchone()
+                self.size_bytes += len(row[2]) - (replaced[0] if replaced else 0)
+            self.conn.executemany('INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)', rows)
+            if self.size_bytes > self.max_size_bytes:
+                self.evict()
+            self.conn.commit()
+
+    def evict(self):
+        target_size = self.max_size_bytes * EVICTION_TARGET_RATIO
+        evicted_count = 0
+        rows = self.conn.execute('SELECT namespace, text_hash, LENGTH(vector) FROM embeddings ORDER BY last_used').fetchall()
+        to_delete = []
+        for namespace, text_hash, size in rows:
+            if self.size_bytes <= target_size:
+                break
+            to_delete.append((namespace, text_hash))
+            self.size_bytes -= size
+            evicted_count += 1
+        self.conn.executemany('DELETE FROM embeddings WHERE namespace = ? AND text_hash = ?', to_delete)
+        logger.info(f"Evicted {evicted_count} entries from the embedding cache")
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'size_bytes': self.size_bytes,
+            }
+
+
+def normalize_query(text: str) -> str:
+    return ' '.join(text.split()).casefold()
+
+
+class QueryEmbeddingCache:
+    """
+    Bounded in-memory LRU cache for query embeddings, keyed by (model namespace, normalized query text).
+    Entries optionally expire after ttl_seconds.
+    """
+
+    def __init__(self, namespace: str, max_entries: int = DEFAULT_MAX_QUERY_CACHE_ENTRIES, ttl_seconds: Optional[float] = None):
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.entries: OrderedDict[Tuple[str, str], Tuple[float, List[float]]] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, text: str) -> Optional[List[float]]:
+        key = (self.namespace, normalize_query(text))
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.ttl_seconds is not None and time.time() - entry[0] > self.ttl_seconds:
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, text: str, vector: List[float]):
+        key = (self.namespace, normalize_query(text))
+        with self.lock:
+            self.entries[key] = (time.time(), vector)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': len(self.entries),
+            }
@@ -0,0 +1,151 @@
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import List, Tuple, Deque, Optional
+
+from langchain_community.vectorstores import Chroma
+from langchain_core.documents import Document
+
+# Pipelined ingestion of documents into a Chroma DB:
+# Several batches are embedded & added to Chroma (via its embedding function) concurrently on a thread pool, while the
+# calling thread collects the finished batches (in submission order) and persists on a time or size threshold.
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_IN_FLIGHT = 4
+
+# Persist whenever one of these thresholds is reached (and once at the end)
+PERSIST_INTERVAL_SECONDS = 60
+PERSIST_EVERY_N_DOCUMENTS = 2048
+
+# Backoff for rate limited (HTTP 429) requests
+MAX_RATE_LIMIT_RETRIES = 8
+INITIAL_BACKOFF_SECONDS = 1.0
+MAX_BACKOFF_SECONDS = 60.0
+
+# After this many successful requests, the allowed concurrency is increased by one again
+SUCCESSES_BEFORE_SPEEDUP = 20
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    status_code = getattr(error, 'status_code', None) or getattr(getattr(error, 'response', None), 'status_code', None)
+    return status_code == 429 or 'rate limit' in str(error).lower()
+
+
+def get_retry_after_seconds(error: Exception) -> Optional[float]:
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Limits the number of concurrent embedding requests.
+    The limit is halved on every rate limit response and slowly increased again after successful requests.
+    """
+
+    def __init__(self, max_concurrency: int):
+        self.max_concurrency = max_concurrency
+        self.concurrency = max_concurrency
+        self.active = 0
+        self.successes = 0
+        self.condition = threading.Condition()
+
+    def __enter__(self):
+        with self.condition:
+            self.condition.wait_for(lambda: self.active < self.concurrency)
+            self.active += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def on_success(self):
+        with self.condition:
+            self.successes += 1
+            if self.successes >= SUCCESSES_BEFORE_SPEEDUP and self.concurrency < self.max_concurrency:
+                self.concurrency += 1
+                self.successes = 0
+                logger.debug(f"Increased embedding concurrency to {self.concurrency}")
+                self.condition.notify_all()
+
+    def on_rate_limit(self):
+        with self.condition:
+            self.successes = 0
+            if self.concurrency > 1:
+                self.concurrency = max(1, self.concurrency // 2)
+                logger.info(f"Rate limited, reduced embedding concurrency to {self.concurrency}")
+
+
+def add_with_backoff(db: Chroma, docs: List[Document], ids: List[str], limiter: AdaptiveConcurrencyLimiter):
+    for attempt in range(MAX_RATE_LIMIT_RETRIES + 1):
+        try:
+            with limiter:
+                db.add_texts([doc.page_content for doc in docs], metadatas=[doc.metadata for doc in docs], ids=ids)
+            limiter.on_success()
+            return
+        except Exception as e:
+            if not is_rate_limit_error(e) or attempt == MAX_RATE_LIMIT_RETRIES:
+                raise
+            limiter.on_rate_limit()
+            backoff = get_retry_after_seconds(e) or min(MAX_BACKOFF_SECONDS, INITIAL_BACKOFF_SECONDS * 2 ** attempt)
+            backoff += random.uniform(0, backoff / 2)
+            logger.warning(f"Embedding request was rate limited, retrying in {backoff:.1f} seconds...")
+            time.sleep(backoff)
+
+
+def ingest_documents(db: Chroma, docs: List[Document], ids: List[str],
+                     batch_size: int, max_in_flight: int = DEFAULT_MAX_IN_FLIGHT) -> int:
+    """
+    Embeds and adds the given documents to the Chroma DB, keeping up to max_in_flight embedding requests running.
+    Each batch is added as soon as it is embedded, so an interrupted ingestion can be resumed by skipping the already
+    embedded IDs. Returns the number of added documents.
+    """
+    limiter = AdaptiveConcurrencyLimiter(max_in_flight)
+    pending: Deque[Tuple[List[Document], Future]] = deque()
+    added_count = 0
+    unpersisted_count = 0
+    last_persist_time = time.time()
+    start_time = time.time()
+
+    def collect_oldest_batch():
+        nonlocal added_count, unpersisted_count, last_persist_time
+        batch_docs, future = pending.popleft()
+        future.result()
+        added_count += len(batch_docs)
+        unpersisted_count += len(batch_docs)
+        logger.debug(f"Added chunk of {len(batch_docs)} new embedded documents to the Chroma DB "
+                     f"({added_count}/{len(docs)})")
+
+        if unpersisted_count >= PERSIST_EVERY_N_DOCUMENTS or time.time() - last_persist_time >= PERSIST_INTERVAL_SECONDS:
+            db.persist()
+            unpersisted_count = 0
+            last_persist_time = time.time()
+            elapsed = time.time() - start_time
+            logger.info(f"Persisted {added_count}/{len(docs)} new documents to the Chroma DB "
+                        f"({added_count / max(elapsed, 1e-6):.1f} documents/s)")
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        try:
+            for i in range(0, len(docs), batch_size):
+                batch_docs = docs[i:i + batch_size]
+                future = executor.submit(add_with_backoff, db, batch_docs, ids[i:i + batch_size], limiter)
+                pending.append((batch_docs, future))
+                # Keep a few more batches queued than in flight, so the workers never wait for the collection
+                if len(pending) > 2 * max_in_flight:
+                    collect_oldest_batch()
+            while pending:
+                collect_oldest_batch()
+        finally:
+            for _, future in pending:
+                future.cancel()
+            db.persist()
+
+    return added_count
@@ -0,0 +1,104 @@
+import json
+import logging
+import os
+import time
+from typing import List, Optional, Set, Tuple, Dict
+
+import numpy as np
+from langchain_community.vectorstores import Chroma
+
+from db.data_dir_contents import EMBEDDING_MATRIX_FILE, EMBEDDING_MATRIX_META_FILE
+
+# Export of all patient journey embeddings of the Chroma DB as one float32 matrix (.npy) & its PID → row index.
+# The matrix is memory-mapped read-only, so all uvicorn workers share the same pages of the OS page cache.
+# Searches within a cohort are exact: vectorized dot products over the rows of the cohort only (instead of a Chroma
+# metadata filter with thousands of PIDs). Unfiltered searches still use Chroma (HNSW).
+# The export is rewritten whenever the data hash or the PIDs in the Chroma DB change.
+
+logger = logging.getLogger(__name__)
+
+NR_OF_EMBEDDINGS_TO_EXPORT_AT_ONCE = 10000
+
+
+class EmbeddingMatrix:
+    def __init__(self, pids: List[str], vectors: np.ndarray):
+        self.pids = pids
+        self.vectors = vectors
+        self.pid_indices: Dict[str, int] = {pid: i for i, pid in enumerate(pids)}
+
+    @classmethod
+    def load(cls) -> 'EmbeddingMatrix':
+        with open(EMBEDDING_MATRIX_META_FILE, 'r') as file:
+            meta = json.load(file)
+        return cls(meta['pids'], np.load(EMBEDDING_MATRIX_FILE, mmap_mode='r'))
+
+    @staticmethod
+    def export(db: Chroma, data_hash: Optional[str]):
+        start_time = time.time()
+        pids = []
+        vectors = None
+        # Each process writes its own temporary files, in case several workers export at the same time
+        temporary_path = f'{EMBEDDING_MATRIX_FILE}.{os.getpid()}.tmp.npy'
+        total_count = len(db)
+        # The embeddings are fetched in batches & written straight into the (memory-mapped) file
+        for offset in range(0, total_count, NR_OF_EMBEDDINGS_TO_EXPORT_AT_ONCE):
+            entries = db.get(include=['embeddings'], limit=NR_OF_EMBEDDINGS_TO_EXPORT_AT_ONCE, offset=offset)
+            batch = np.array(entries['embeddings'], dtype=np.float32)
+            if vectors is None:
+                vectors = np.lib.format.open_memmap(temporary_path, mode='w+', dtype=np.float32,
+                                                    shape=(total_count, batch.shape[1]))
+            vectors[len(pids):len(pids) + len(batch)] = batch
+            pids.extend(entries['ids'])
+        if vectors is None:
+            vectors = np.lib.format.open_memmap(temporary_path, mode='w+', dtype=np.float32, shape=(0, 0))
+        vectors.flush()
+        del vectors
+        os.replace(temporary_path, EMBEDDING_MATRIX_FILE)
+
+        # The meta file is written last, so it only ever describes a complete matrix
+        temporary_path = f'{EMBEDDING_MATRIX_META_FILE}.{os.getpid()}.tmp'
+        with open(temporary_path, 'w') as file:
+            json.dump({'data_hash': data_hash, 'pids': pids}, file)
+        os.replace(temporary_path, EMBEDDING_MATRIX_META_FILE)
+        logger.info(f"Exported {len(pids)} embeddings to {EMBEDDING_MATRIX_FILE} in {time.time() - start_time:.1f} seconds")
+
+    def get_rows(self, pids: List[str]) -> np.ndarray:
+        # Sorted rows are read sequentially from the memory-mapped file
+        return np.sort(np.fromiter((self.pid_indices[pid] for pid in set(pids) if pid in self.pid_indices),
+                                   dtype=np.int64))
+
+    def search(self, query_vector: List[float], k: int, pids: List[str]) -> List[Tuple[str, float]]:
+        """
+        Returns the k nearest patients within the given PIDs, with their squared L2 distances (ascending),
+        i.e. the same ranking as the (default) L2 space of Chroma.
+        """
+        rows = self.get_rows(pids)
+        if not len(rows) or k <= 0:
+            return []
+        vectors = self.vectors[rows]
+        query = np.asarray(query_vector, dtype=np.float32)
+        # ||q - v||² = ||q||² - 2 q·v + ||v||², all rows at once (BLAS)
+        distances = np.einsum('ij,ij->i', vectors, vectors) - 2 * (vectors @ query) + query @ query
+        k = min(k, len(rows))
+        best = np.argpartition(distances, k - 1)[:k]
+        best = best[np.argsort(distances[best], kind='stable')]
+        return [(self.pids[rows[i]], float(distances[i])) for i in best]
+
+
+def is_export_outdated(db: Chroma, data_hash: Optional[str]) -> bool:
+    if not os.path.exists(EMBEDDING_MATRIX_FILE) or not os.path.exists(EMBEDDING_MATRIX_META_FILE):
+        return True
+    with open(EMBEDDING_MATRIX_META_FILE, 'r') as file:
+        meta = json.load(file)
+    if meta['data_hash'] != data_hash:
+        return True
+    # E.g. after an interrupted ingestion, the Chroma DB is completed on the next start
+    return set(meta['pids']) != set(db.get(include=[])['ids'])
+
+
+def init_embedding_matrix(db: Chroma, data_hash: str, outdated_pids: Set[str] = frozenset()) -> EmbeddingMatrix:
+    if outdated_pids or is_export_outdated(db, data_hash):
+        EmbeddingMatrix.export(db, data_hash)
+    else:
+        logger.info(f"Embedding matrix {EMBEDDING_MATRIX_FILE} is up to date")
+    return EmbeddingMatrix.load()
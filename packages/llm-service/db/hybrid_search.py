@@ -0,0 +1,103 @@
+import logging
+from typing import List, Optional, Dict, Tuple
+
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+
+from db.bm25_index import BM25Index
+from db.chroma_db import PID_METADATA_FIELD_NAME
+from db.embedding_matrix import EmbeddingMatrix
+from db.journey_chunks import search_chunks, SCORE_AGGREGATIONS, DEFAULT_SCORE_AGGREGATION
+
+# Retrieval of patient journeys in one of three modes:
+# - vector: similarity search in the vector store, the chunk index or – within a cohort – the embedding matrix
+#   (requires a query embedding)
+# - lexical: BM25 search in the local lexical index (no network access at all)
+# - hybrid: both result lists fused by their ranks (reciprocal rank fusion)
+# Vector search (the Chroma-only path) is the default, lexical & hybrid retrieval are opt-in (RETRIEVAL_MODE).
+
+logger = logging.getLogger(__name__)
+
+RETRIEVAL_MODES = ['vector', 'lexical', 'hybrid']
+DEFAULT_RETRIEVAL_MODE = 'vector'
+
+# Each ranking contributes 1 / (RRF_K + rank), the constant dampens the influence of the top ranks
+RRF_K = 60
+
+# Each ranking fetches this many times more candidates than requested, to have enough overlap for the fusion
+CANDIDATES_FACTOR = 4
+
+
+def create_pid_filter(pids: Optional[List[str]]) -> Optional[dict]:
+    return {PID_METADATA_FIELD_NAME: {'$in': pids}} if pids else None
+
+
+def fuse_rankings(rankings: List[List[str]], k: int) -> List[str]:
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, pid in enumerate(ranking):
+            scores[pid] = scores.get(pid, 0.0) + 1.0 / (RRF_K + rank + 1)
+    # Ties are broken by the order of first appearance (sorted() is stable)
+    return sorted(scores, key=lambda pid: -scores[pid])[:k]
+
+
+class HybridSearch:
+    """
+    If a chunk store is given, the vector search runs on the chunk index and returns the matching chunks of each
+    patient journey, otherwise it runs on the whole journeys.
+    If an embedding matrix is given, searches within a cohort (PIDs) run on its rows instead, on the whole journeys:
+    A Chroma metadata filter with thousands of PIDs is slow (and may fail).
+    """
+
+    def __init__(self, db: VectorStore, index: BM25Index, mode: str = DEFAULT_RETRIEVAL_MODE,
+                 chunk_store: Optional[VectorStore] = None, chunk_score_aggregation: str = DEFAULT_SCORE_AGGREGATION,
+                 embedding_matrix: Optional[EmbeddingMatrix] = None):
+        if mode not in RETRIEVAL_MODES:
+            raise ValueError(f"Invalid retrieval mode: {mode}")
+        if chunk_score_aggregation not in SCORE_AGGREGATIONS:
+            raise ValueError(f"Invalid chunk score aggregation: {chunk_score_aggregation}")
+        self.db = db
+        self.index = index
+        self.mode = mode
+        self.chunk_store = chunk_store
+        self.chunk_score_aggregation = chunk_score_aggregation
+        self.embedding_matrix = embedding_matrix
+
+    def vector_search(self, query: str, k: int, pids: Optional[List[str]]) -> List[Tuple[str, List[Document]]]:
+        if pids and self.embedding_matrix is not None:
+            nearest_pids = [pid for pid, _ in self.embedding_matrix.search(self.db.embeddings.embed_query(query), k, pids)]
+            return [(doc.metadata[PID_METADATA_FIELD_NAME], [doc]) for doc in self.get_documents(nearest_pids)]
+        if self.chunk_store is not None:
+            return search_chunks(self.chunk_store, query, k, pids, self.chunk_score_aggregation)
+        docs = self.db.similarity_search(query, k=k, filter=create_pid_filter(pids))
+        return [(doc.metadata[PID_METADATA_FIELD_NAME], [doc]) for doc in docs]
+
+    def lexical_search(self, query: str, k: int, pids: Optional[List[str]]) -> List[str]:
+        return [pid for pid, _ in self.index.search(query, k, pids)]
+
+    def get_documents(self, pids: List[str]) -> List[Document]:
+        # A get by ID is answered by the local vector store, no embedding needed
+        result = self.db.get(ids=pids)
+        contents = dict(zip(result['ids'], result['documents']))
+        return [Document(page_content=contents[pid], metadata={PID_METADATA_FIELD_NAME: pid}) for pid in pids if pid in contents]
+
+    def search(self, query: str, k: int, pids: Optional[List[str]] = None, mode: Optional[str] = None) -> List[Document]:
+        """Returns the documents (whole journeys or matching chunks) of the k most relevant patients."""
+        mode = mode or self.mode
+        if mode == 'vector':
+            return [doc for _, docs in self.vector_search(query, k, pids) for doc in docs]
+        if mode == 'lexical':
+            return self.get_documents(self.lexical_search(query, k, pids))
+
+        vector_results = self.vector_search(query, k * CANDIDATES_FACTOR, pids)
+        lexical_pids = self.lexical_search(query, k * CANDIDATES_FACTOR, pids)
+        vector_pids = [pid for pid, _ in vector_results]
+        fused_pids = fuse_rankings([vector_pids, lexical_pids], k)
+        logger.debug(f"Hybrid search: {len(vector_pids)} vector and {len(lexical_pids)} lexical candidates, "
+                     f"{len(set(vector_pids) & set(lexical_pids))} in both")
+
+        # Patients only found by the lexical search are returned with their whole journey
+        docs_by_pid = dict(vector_results)
+        missing_docs = self.get_documents([pid for pid in fused_pids if pid not in docs_by_pid])
+        docs_by_pid.update({doc.metadata[PID_METADATA_FIELD_NAME]: [doc] for doc in missing_docs})
+        return [doc for pid in fused_pids for doc in docs_by_pid.get(pid, [])]
@@ -0,0 +1,149 @@
+import logging
+from typing import Iterator, List, Optional, Set, Dict, Tuple
+
+from langchain_community.vectorstores import Chroma
+from langchain_core.documents import Document
+
+from db.chroma_db import PID_METADATA_FIELD_NAME, NR_OF_DOCS_TO_DELETE_AT_ONCE, get_embedding_batch_size
+from db.data_dir_contents import CHROMA_PERSIST_DIR
+from db.data_frames import PATIENT_ID_COLUMN_NAME, COLUMN_TYPES_ATTR
+from db.embedding_ingestion import ingest_documents, DEFAULT_MAX_IN_FLIGHT
+from db.manifest import Manifest
+from db.prepare_patient_journeys import create_render_chunks, render_patient_journey
+from db.shared import LoadedDataFrames
+from utils.get_env import get_env
+
+# Chunk-level index of the patient journeys:
+# Every journey is split into windows of consecutive events, each rendered with the patient information and embedded
+# on its own. Long journeys thus don't end up as one blurred (averaged) vector, and a search can return the matching
+# parts of a journey instead of the whole report. Chunk hits are aggregated to patients (max or sum of the scores).
+
+logger = logging.getLogger(__name__)
+
+CHUNKS_COLLECTION_NAME = 'patient_journey_chunks'
+
+EVENTS_PER_CHUNK = 20
+
+CHUNK_METADATA_FIELD_NAME = 'Chunk'
+START_METADATA_FIELD_NAME = 'Start'
+END_METADATA_FIELD_NAME = 'End'
+# The content hash of the journey (from the manifest) the chunk was rendered from
+CONTENT_HASH_METADATA_FIELD_NAME = 'Content Hash'
+
+SCORE_AGGREGATIONS = ['max', 'sum']
+DEFAULT_SCORE_AGGREGATION = 'max'
+
+# Each search fetches this many chunks per requested patient, to have enough chunks for the aggregation
+CHUNKS_PER_PATIENT_FACTOR = 4
+
+
+def is_chunk_index_enabled() -> bool:
+    return (get_env('JOURNEY_CHUNK_INDEX') or 'false').lower() == 'true'
+
+
+def get_chunk_count(event_count: int) -> int:
+    # Patients without events are indexed with one chunk (the patient information only)
+    return max(1, -(-event_count // EVENTS_PER_CHUNK))
+
+
+def find_timestamp_column(data_frames: LoadedDataFrames) -> Optional[str]:
+    column_types = data_frames['events'].attrs.get(COLUMN_TYPES_ATTR, {})
+    return next((column for column, column_type in column_types.items() if column_type == 'timestamp'), None)
+
+
+def create_chunk_documents(data_frames: LoadedDataFrames, pids: Set[str], manifest: Manifest) -> Iterator[Tuple[str, Document]]:
+    timestamp_column = find_timestamp_column(data_frames)
+    for render_chunk in create_render_chunks(data_frames, pids):
+        for patient, events in render_chunk:
+            pid = patient[PATIENT_ID_COLUMN_NAME]
+            for chunk_index in range(get_chunk_count(len(events))):
+                window = events[chunk_index * EVENTS_PER_CHUNK:(chunk_index + 1) * EVENTS_PER_CHUNK]
+                metadata = {PID_METADATA_FIELD_NAME: pid, CHUNK_METADATA_FIELD_NAME: chunk_index,
+                            CONTENT_HASH_METADATA_FIELD_NAME: manifest[pid]}
+                # The time range allows to put the chunk into the context of the journey (and to filter by time)
+                timestamps = [event[timestamp_column] for event in window
+                              if timestamp_column is not None and event[timestamp_column] == event[timestamp_column]]
+                if timestamps:
+                    metadata[START_METADATA_FIELD_NAME] = int(min(timestamps))
+                    metadata[END_METADATA_FIELD_NAME] = int(max(timestamps))
+                text = render_patient_journey(patient, window, event_offset=chunk_index * EVENTS_PER_CHUNK)
+                yield f"{pid}:{chunk_index}", Document(page_content=text, metadata=metadata)
+
+
+def get_indexed_content_hashes(chunk_store: Chroma) -> Dict[str, List[Optional[str]]]:
+    # The content hash of every indexed chunk, by patient ID
+    content_hashes: Dict[str, List[Optional[str]]] = {}
+    for metadata in chunk_store.get(include=['metadatas'])['metadatas']:
+        content_hashes.setdefault(metadata[PID_METADATA_FIELD_NAME], []) \
+            .append(metadata.get(CONTENT_HASH_METADATA_FIELD_NAME))
+    return content_hashes
+
+
+def get_expected_chunk_counts(data_frames: LoadedDataFrames) -> Dict[str, int]:
+    event_counts = data_frames['events'].groupby(PATIENT_ID_COLUMN_NAME, sort=False).size()
+    return {pid: get_chunk_count(int(event_counts.get(pid, 0))) for pid in data_frames['patients'][PATIENT_ID_COLUMN_NAME]}
+
+
+def delete_chunks(chunk_store: Chroma, pids: Set[str]):
+    pids = list(pids)
+    for i in range(0, len(pids), NR_OF_DOCS_TO_DELETE_AT_ONCE):
+        chunk_ids = chunk_store.get(where={PID_METADATA_FIELD_NAME: {'$in': pids[i:i + NR_OF_DOCS_TO_DELETE_AT_ONCE]}},
+                                    include=[])['ids']
+        if chunk_ids:
+            chunk_store.delete(ids=chunk_ids)
+    logger.info(f"Deleted the chunks of {len(pids)} outdated patient journeys from the chunk index")
+
+
+def init_chunk_index(vector_store: Chroma, data_frames: LoadedDataFrames, manifest: Manifest) -> Chroma:
+    # The chunks are stored in a separate collection of the same Chroma DB (and embedded the same way)
+    chunk_store = Chroma(collection_name=CHUNKS_COLLECTION_NAME, embedding_function=vector_store.embeddings,
+                         persist_directory=CHROMA_PERSIST_DIR)
+
+    # Each journey is compared by its content hash (from the manifest), independent of the changes detected since the
+    # last run – the index may have been disabled meanwhile. Journeys with other content or a different number of
+    # chunks than expected are changed, removed, partially indexed (e.g. after an interrupted ingestion) or new –
+    # they are (re-)indexed from scratch
+    indexed_content_hashes = get_indexed_content_hashes(chunk_store)
+    expected_chunk_counts = get_expected_chunk_counts(data_frames)
+    mismatching_pids = {pid for pid in indexed_content_hashes.keys() | expected_chunk_counts.keys()
+                        if len(indexed_content_hashes.get(pid, [])) != expected_chunk_counts.get(pid, 0)
+                        or any(content_hash != manifest.get(pid) for content_hash in indexed_content_hashes.get(pid, []))}
+
+    outdated_pids = mismatching_pids & indexed_content_hashes.keys()
+    if outdated_pids:
+        delete_chunks(chunk_store, outdated_pids)
+
+    pids_to_index = mismatching_pids & expected_chunk_counts.keys()
+    if pids_to_index:
+        ids, docs = zip(*create_chunk_documents(data_frames, pids_to_index, manifest))
+        logger.info(f"{len(docs)} chunks of {len(pids_to_index)} patient journeys need to be embedded and added to the chunk index")
+        ingest_documents(chunk_store, list(docs), list(ids),
+                         batch_size=get_embedding_batch_size(get_env('EMBEDDING_PROVIDER')),
+                         max_in_flight=int(get_env('EMBEDDING_MAX_IN_FLIGHT') or DEFAULT_MAX_IN_FLIGHT))
+    else:
+        logger.info('All patient journeys already exist in the chunk index')
+
+    return chunk_store
+
+
+def search_chunks(chunk_store: Chroma, query: str, k: int, pids: Optional[List[str]] = None,
+                  aggregation: str = DEFAULT_SCORE_AGGREGATION) -> List[Tuple[str, List[Document]]]:
+    """
+    Returns the k best matching patients (optionally only within the given PIDs), each with its matching chunks
+    (in journey order). Patients are ranked by the max or sum of the relevance scores of their matching chunks.
+    """
+    search_filter = {PID_METADATA_FIELD_NAME: {'$in': pids}} if pids else None
+    results = chunk_store.similarity_search_with_relevance_scores(query, k=k * CHUNKS_PER_PATIENT_FACTOR,
+                                                                  filter=search_filter)
+    scores: Dict[str, float] = {}
+    chunks: Dict[str, List[Document]] = {}
+    for doc, score in results:
+        pid = doc.metadata[PID_METADATA_FIELD_NAME]
+        if aggregation == 'sum':
+            scores[pid] = scores.get(pid, 0.0) + score
+        else:
+            scores[pid] = max(scores.get(pid, score), score)
+        chunks.setdefault(pid, []).append(doc)
+
+    best_pids = sorted(scores, key=lambda pid: -scores[pid])[:k]
+    return [(pid, sorted(chunks[pid], key=lambda doc: doc.metadata[CHUNK_METADATA_FIELD_NAME])) for pid in best_pids]
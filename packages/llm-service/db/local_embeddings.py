@@ -0,0 +1,93 @@
+import logging
+import os
+import random
+import time
+from typing import List
+
+import joblib
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from sklearn.decomposition import TruncatedSVD
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.pipeline import Pipeline, make_pipeline
+from sklearn.preprocessing import Normalizer
+
+from db.bm25_index import TOKEN_PATTERN
+from utils.hash import calculate_hash
+
+# Offline embeddings (TF-IDF + truncated SVD, i.e. latent semantic analysis) fitted on the patient journey reports.
+# No network access is needed, neither for the ingestion nor for queries (e.g. in air-gapped environments or
+# to comply with the MIMIC data use agreement).
+# The fitted model is persisted and reused, even if the reports change later on: Refitting changes the embedding
+# space, so the model file and the Chroma DB have to be deleted together to refit it.
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LOCAL_EMBEDDING_DIMENSIONS = 256
+
+# The model is fitted on a random sample of at most this many reports
+MAX_NR_OF_FIT_DOCUMENTS = 50000
+
+# Terms occurring in fewer documents are ignored (unless the corpus is tiny)
+MIN_DOCUMENT_FREQUENCY = 2
+MAX_NR_OF_FEATURES = 200000
+
+# Large batches are transformed in parallel (on all cores), small ones aren't worth the inter-process overhead
+MIN_TEXTS_PER_PARALLEL_CHUNK = 256
+
+# BLAS threads of each process transforming a chunk (the parallelism comes from the processes)
+MAX_BLAS_THREADS_PER_PROCESS = 1
+
+
+def fit_model(file_path: str, dimensions: int) -> Pipeline:
+    with open(file_path, 'r', encoding='utf-8') as file:
+        texts = file.readlines()
+    if len(texts) > MAX_NR_OF_FIT_DOCUMENTS:
+        texts = random.Random(0).sample(texts, MAX_NR_OF_FIT_DOCUMENTS)
+
+    vectorizer = TfidfVectorizer(token_pattern=TOKEN_PATTERN.pattern, sublinear_tf=True, dtype=np.float32,
+                                 min_df=MIN_DOCUMENT_FREQUENCY if len(texts) >= 100 else 1,
+                                 max_features=MAX_NR_OF_FEATURES)
+    tfidf = vectorizer.fit_transform(texts)
+    # The SVD needs fewer components than documents and terms
+    svd = TruncatedSVD(n_components=max(1, min(dimensions, tfidf.shape[0] - 1, tfidf.shape[1] - 1)), random_state=0)
+    # Normalized vectors make the (default) L2 distance of Chroma equivalent to the cosine distance
+    normalizer = Normalizer(copy=False).fit(svd.fit_transform(tfidf))
+    return make_pipeline(vectorizer, svd, normalizer)
+
+
+class LocalEmbeddings(Embeddings):
+    def __init__(self, model: Pipeline, model_id: str):
+        self.model = model
+        self.model_id = model_id
+
+    @classmethod
+    def load_or_fit(cls, model_file: str, corpus_file: str, dimensions: int = DEFAULT_LOCAL_EMBEDDING_DIMENSIONS) -> 'LocalEmbeddings':
+        if not os.path.exists(model_file):
+            start_time = time.time()
+            model = fit_model(corpus_file, dimensions)
+            temporary_path = model_file + '.tmp'
+            joblib.dump(model, temporary_path)
+            os.replace(temporary_path, model_file)
+            logger.info(f"Local embedding model has been fitted on {corpus_file} in {time.time() - start_time:.1f} seconds")
+        # The hash of the model file identifies the embedding space (e.g. for the embedding caches)
+        return cls(joblib.load(model_file), calculate_hash(model_file))
+
+    def transform(self, texts: List[str]) -> np.ndarray:
+        return self.model.transform(texts)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        chunk_count = min(os.cpu_count() or 1, len(texts) // MIN_TEXTS_PER_PARALLEL_CHUNK)
+        if chunk_count <= 1:
+            return self.transform(texts).tolist()
+
+        chunk_size = -(-len(texts) // chunk_count)
+        chunks = [texts[i:i + chunk_size] for i in range(0, len(texts), chunk_size)]
+        # The tokenization is pure Python, so the chunks are transformed in separate processes. Each process is limited
+        # to one BLAS thread (for the SVD projection), so the processes don't oversubscribe the cores
+        with joblib.parallel_config(backend='loky', inner_max_num_threads=MAX_BLAS_THREADS_PER_PROCESS):
+            vectors = joblib.Parallel(n_jobs=chunk_count)(joblib.delayed(self.transform)(chunk) for chunk in chunks)
+        return np.vstack(vectors).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
@@ -0,0 +1,82 @@
+import hashlib
+import json
+import logging
+import os
+from typing import Dict, Optional, Set, TypedDict, List
+
+import pandas as pd
+
+from db.data_dir_contents import MANIFEST_FILE
+from db.data_frames import PATIENT_ID_COLUMN_NAME
+from db.shared import LoadedDataFrames
+
+# The manifest maps every patient ID to a content hash of the patient row and all of its events.
+# Comparing the manifests of two data versions tells which patient journeys were added, changed or removed.
+
+logger = logging.getLogger(__name__)
+
+Manifest = Dict[str, str]
+
+FIELD_SEPARATOR = '\x1f'
+RECORD_SEPARATOR = b'\x1e'
+
+
+class ManifestDiff(TypedDict):
+    added: Set[str]
+    changed: Set[str]
+    removed: Set[str]
+
+
+def create_row_texts(df: pd.DataFrame) -> List[str]:
+    texts = df.iloc[:, 0].astype(str)
+    for column in df.columns[1:]:
+        texts = texts + FIELD_SEPARATOR + df[column].astype(str)
+    return texts.tolist()
+
+
+def create_manifest(data_frames: LoadedDataFrames) -> Manifest:
+    patients_df = data_frames['patients']
+    events_df = data_frames['events']
+
+    # Column names are part of the hash, so schema changes are detected as well
+    patient_header = FIELD_SEPARATOR.join(patients_df.columns).encode('utf-8')
+    event_header = FIELD_SEPARATOR.join(events_df.columns).encode('utf-8')
+
+    event_texts = create_row_texts(events_df)
+    event_indices_by_pid = events_df.groupby(PATIENT_ID_COLUMN_NAME, sort=False).indices
+
+    manifest = {}
+    for pid, patient_text in zip(patients_df[PATIENT_ID_COLUMN_NAME], create_row_texts(patients_df)):
+        content_hash = hashlib.sha256(patient_header)
+        content_hash.update(RECORD_SEPARATOR + patient_text.encode('utf-8'))
+        content_hash.update(RECORD_SEPARATOR + event_header)
+        for i in event_indices_by_pid.get(pid, []):
+            content_hash.update(RECORD_SEPARATOR + event_texts[i].encode('utf-8'))
+        manifest[pid] = content_hash.hexdigest()
+    return manifest
+
+
+def load_manifest() -> Optional[Manifest]:
+    if not os.path.exists(MANIFEST_FILE):
+        return None
+    with open(MANIFEST_FILE, 'r') as file:
+        return json.load(file)
+
+
+def save_manifest(manifest: Manifest):
+    with open(MANIFEST_FILE, 'w') as file:
+        json.dump(manifest, file)
+
+
+def diff_manifests(old_manifest: Manifest, new_manifest: Manifest) -> ManifestDiff:
+    old_pids = set(old_manifest)
+    new_pids = set(new_manifest)
+    return {
+        'added': new_pids - old_pids,
+        'changed': {pid for pid in old_pids & new_pids if old_manifest[pid] != new_manifest[pid]},
+        'removed': old_pids - new_pids,
+    }
+
+
+def has_changes(diff: Optional[ManifestDiff]) -> bool:
+    return diff is not None and any(diff.values())
@@ -1,21 +1,19 @@
 import os
 import logging
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List, Tuple, Optional, Set
 
 from jinja2 import Environment, BaseLoader
 
 from db.data_dir_contents import PATIENT_REPORTS_TXT, PATIENTS_CSV
+from db.data_frames import PATIENT_ID_COLUMN_NAME, format_dates
 from db.shared import LoadedDataFrames
 
 logger = logging.getLogger(__name__)
 
-# This script reads patient and event data from CSV files and writes patient journey reports to a text file
-# based on a Jinja2 template.
-def prepare_patient_journeys(data_frames: LoadedDataFrames):
-    patients_df = data_frames['patients']
-    events_df = data_frames['events']
-
-    # Jinja2 template for patient journeys
-    template_source = """
+# Jinja2 template for patient journeys
+TEMPLATE_SOURCE = """
     Patient information:
     {% for key, value in patient.items() %}
     {{ key }}: {{ value }}
@@ -23,36 +21,127 @@ def prepare_patient_journeys(data_frames: LoadedDataFrames):
 
     The patients' journey through the hospital:
     {% for event in events %}
-    Event {{ loop.index }}:
+    Event {{ loop.index + event_offset }}:
     {% for key, value in event.items() %}
     {{ key }}: {{ value }}
     {% endfor %}
     {% endfor %}
     """
 
-    # Prepare the Jinja2 template
-    env = Environment(loader=BaseLoader())
-    template = env.from_string(template_source.strip())
+# Number of patients handed to a worker process at once
+PATIENTS_PER_RENDER_CHUNK = 500
+
+# Data sets smaller than this are rendered in-process (spawning workers is not worth it)
+MIN_PATIENTS_FOR_PARALLEL_RENDERING = 2 * PATIENTS_PER_RENDER_CHUNK
+
+# The compiled template is cached per process, since jinja2 templates cannot be pickled
+_template = None
+
+
+def get_template():
+    global _template
+    if _template is None:
+        env = Environment(loader=BaseLoader())
+        _template = env.from_string(TEMPLATE_SOURCE.strip())
+    return _template
+
+
+# The event offset is used to render a part of a journey (with the event numbers of the whole journey)
+def render_patient_journey(patient: dict, events: List[dict], event_offset: int = 0) -> str:
+    journey_text = get_template().render({'patient': patient, 'events': events, 'event_offset': event_offset}) \
+        .replace('\n', ' ').strip()
+    return f'{patient[PATIENT_ID_COLUMN_NAME]} {journey_text}\n'
+
+
+def render_patient_journeys(chunk: List[Tuple[dict, List[dict]]]) -> str:
+    return ''.join(render_patient_journey(patient, events) for patient, events in chunk)
+
+
+def create_render_chunks(data_frames: LoadedDataFrames, pids: Optional[Set[str]] = None) -> Iterator[List[Tuple[dict, List[dict]]]]:
+    patients_df = data_frames['patients']
+    events_df = data_frames['events']
+
+    if pids is not None:
+        patients_df = patients_df[patients_df[PATIENT_ID_COLUMN_NAME].isin(pids)]
+        events_df = events_df[events_df[PATIENT_ID_COLUMN_NAME].isin(pids)]
+
+    # Group the events once (instead of filtering the events table per patient).
+    # The group indices preserve the original event order within each patient.
+    # Dates are rendered in DATE_FORMAT (as in the input files), not as the parsed timestamps.
+    event_records = format_dates(events_df).to_dict(orient='records')
+    event_indices_by_pid = events_df.groupby(PATIENT_ID_COLUMN_NAME, sort=False).indices
+
+    chunk = []
+    for patient in format_dates(patients_df).to_dict(orient='records'):
+        event_indices = event_indices_by_pid.get(patient[PATIENT_ID_COLUMN_NAME], [])
+        chunk.append((patient, [event_records[i] for i in event_indices]))
+        if len(chunk) == PATIENTS_PER_RENDER_CHUNK:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# Yields the rendered patient journeys chunk by chunk (in the original patient order)
+def render_chunks(data_frames: LoadedDataFrames, patient_count: int, pids: Optional[Set[str]] = None) -> Iterator[str]:
+    chunks = create_render_chunks(data_frames, pids)
+    if patient_count < MIN_PATIENTS_FOR_PARALLEL_RENDERING:
+        for chunk in chunks:
+            yield render_patient_journeys(chunk)
+    else:
+        with ProcessPoolExecutor() as executor:
+            yield from executor.map(render_patient_journeys, chunks)
+
+
+def log_throughput(patient_count: int, start_time: float):
+    duration = time.time() - start_time
+    logger.info(f"Rendered {patient_count} patient journeys in {duration:.1f} seconds "
+                f"({patient_count / max(duration, 1e-6):.0f} patients/s)")
+
+
+# This script reads patient and event data from CSV files and writes patient journey reports to a text file
+# based on a Jinja2 template.
+def prepare_patient_journeys(data_frames: LoadedDataFrames):
+    patient_count = len(data_frames['patients'])
+    start_time = time.time()
 
     # Prepare and write patient journeys to a text file
     with open(PATIENT_REPORTS_TXT, 'w') as file:
-        for index, patient in patients_df.iterrows():
-            patient_id = patient['Patient ID']
-            patient_events = events_df[events_df['Patient ID'] == patient_id].to_dict(orient='records')
+        for rendered_chunk in render_chunks(data_frames, patient_count):
+            file.write(rendered_chunk)
 
-            # Creating the context
-            context = {
-                'patient': patient.to_dict(),
-                'events': patient_events,
-            }
+    logger.info(f"Patient journey reports have been written to {PATIENT_REPORTS_TXT}")
+    log_throughput(patient_count, start_time)
 
-            # Rendering the template
-            journey_text = template.render(context).replace('\n', ' ').strip()
 
-            # Write to file
-            file.write(f'{patient_id} {journey_text}\n')
+# Re-renders the given patient journeys only, keeps all other reports and drops reports of removed patients
+def refresh_patient_journeys(data_frames: LoadedDataFrames, pids_to_render: Set[str]):
+    start_time = time.time()
 
-    logger.info(f"Patient journey reports have been written to {PATIENT_REPORTS_TXT}")
+    existing_reports = {}
+    if os.path.exists(PATIENT_REPORTS_TXT):
+        with open(PATIENT_REPORTS_TXT, 'r') as file:
+            for line in file:
+                existing_reports[line.split()[0]] = line
+
+    # Patients without a report (e.g. after an interrupted refresh) are rendered as well
+    all_pids = data_frames['patients'][PATIENT_ID_COLUMN_NAME]
+    pids_to_render = set(pids_to_render) | {pid for pid in all_pids if pid not in existing_reports}
+
+    rendered_reports = {}
+    for rendered_chunk in render_chunks(data_frames, len(pids_to_render), pids_to_render):
+        for line in rendered_chunk.splitlines(keepends=True):
+            rendered_reports[line.split()[0]] = line
+
+    # Written to a temporary file first, so an interrupted refresh never leaves a truncated reports file behind
+    temporary_path = PATIENT_REPORTS_TXT + '.tmp'
+    with open(temporary_path, 'w') as file:
+        for pid in all_pids:
+            file.write(rendered_reports.get(pid) or existing_reports[pid])
+    os.replace(temporary_path, PATIENT_REPORTS_TXT)
+
+    logger.info(f"Refreshed {len(pids_to_render)} patient journey reports in {PATIENT_REPORTS_TXT}")
+    log_throughput(len(pids_to_render), start_time)
 
 
 # Check if the patient journey reports have already been prepared and are plausible
@@ -0,0 +1,288 @@
+import logging
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import List, Tuple, Iterator, Set, Optional
+
+from db.data_dir_contents import SQLITE_DB_FILE, HASH_FILE
+from db.sqlite_db import get_db_file_signature
+
+# Guarded execution of (LLM generated) SQL queries against the SQLite DB:
+# Queries run on a pool of read-only connections, are checked for cartesian products before execution,
+# are interrupted when they exceed their time budget and return at most a limited number of rows.
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POOL_SIZE = 4
+DEFAULT_QUERY_TIMEOUT_SECONDS = 10
+DEFAULT_MAX_RESULT_ROWS = 200
+DEFAULT_MAX_RESULT_CACHE_SIZE_MB = 64
+
+# The progress handler is called every this many SQLite virtual machine instructions
+PROGRESS_HANDLER_INSTRUCTIONS = 10000
+
+TRUNCATED_MARKER = '... (truncated, more than {max_rows} rows – refine the query, e.g. with aggregations or a LIMIT clause)'
+
+# Query plan details of full scans – scans of constant rows, virtual tables (e.g. json_each) and
+# materialized subqueries are not table scans
+SCAN_DETAIL_PATTERN = re.compile(r'^SCAN (\S+)')
+IGNORED_SCAN_DETAILS = ('CONSTANT ROW', 'VIRTUAL TABLE')
+INTERMEDIATE_RESULT_PATTERN = re.compile(r'^(?:MATERIALIZE|CO-ROUTINE) (\S+)')
+
+# Text check for cartesian products the plan doesn't reveal: It is limited to simple queries (without subqueries or
+# CTEs) listing plain tables separated by commas or CROSS JOIN, so a table is only reported if no WHERE predicate
+# relates it to another table. String literals & comments are blanked out first.
+LITERAL_OR_COMMENT_PATTERN = re.compile(r"--[^\n]*|/\*.*?\*/|'(?:[^']|'')*'", re.DOTALL)
+IDENTIFIER = r'(?:"(?:[^"]|"")+"|`[^`]+`|\[[^\]]+\]|\w+)'
+CLAUSE_KEYWORD = r'(?:WHERE|GROUP|HAVING|ORDER|LIMIT|WINDOW|CROSS|JOIN|ON|USING|NATURAL|LEFT|RIGHT|FULL|INNER|OUTER)\b'
+TABLE_REFERENCE = rf'({IDENTIFIER})(?:\s+(?:AS\s+)?(?!{CLAUSE_KEYWORD})({IDENTIFIER}))?'
+TABLE_REFERENCE_PATTERN = re.compile(TABLE_REFERENCE, re.IGNORECASE)
+TABLE_SEPARATOR = r'\s*(?:,|\bCROSS\s+JOIN\b)\s*'
+TABLE_LIST_PATTERN = re.compile(
+    rf'\bFROM\s+({TABLE_REFERENCE}(?:{TABLE_SEPARATOR}{TABLE_REFERENCE})+)\s*'
+    rf'(?:\bWHERE\b(?P<condition>.*?))?\s*(?:\b(?:GROUP|HAVING|ORDER|LIMIT|WINDOW)\b.*)?;?\s*$', re.IGNORECASE | re.DOTALL)
+SELECT_PATTERN = re.compile(r'\bSELECT\b', re.IGNORECASE)
+QUALIFIER_PATTERN = re.compile(rf'({IDENTIFIER})\s*\.\s*{IDENTIFIER}')
+PREDICATE_SEPARATOR_PATTERN = re.compile(r'[()]|\bAND\b', re.IGNORECASE)
+
+# Results of queries using these functions change between runs, so they are not cached
+NON_DETERMINISTIC_PATTERN = re.compile(r"\b(?:random|randomblob|current_(?:date|time|timestamp))\b|'now'", re.IGNORECASE)
+
+
+class QueryRejectedError(ValueError):
+    pass
+
+
+class QueryTimeoutError(TimeoutError):
+    pass
+
+
+def find_cartesian_products(plan: List[Tuple[int, int, int, str]]) -> List[List[str]]:
+    """
+    Returns the groups of tables which are fully scanned within the same loop level of the query plan.
+    SQLite executes joins as nested loops, so two sibling full scans multiply the number of visited rows.
+    """
+    intermediate_results: Set[str] = {match.group(1) for *_, detail in plan
+                                      if (match := INTERMEDIATE_RESULT_PATTERN.match(detail))}
+    scans_by_parent = {}
+    for _, parent, _, detail in plan:
+        match = SCAN_DETAIL_PATTERN.match(detail)
+        if not match or any(ignored in detail for ignored in IGNORED_SCAN_DETAILS) or match.group(1) in intermediate_results:
+            continue
+        scans_by_parent.setdefault(parent, []).append(match.group(1))
+    return [tables for tables in scans_by_parent.values() if len(tables) > 1]
+
+
+def normalize_identifier(identifier: str) -> str:
+    return identifier.strip('"`[]').replace('""', '"').lower()
+
+
+def split_predicates(condition: str) -> List[str]:
+    # Splits a condition at the AND operators outside of parentheses
+    predicates, depth, start = [], 0, 0
+    for match in PREDICATE_SEPARATOR_PATTERN.finditer(condition):
+        if match.group() == '(':
+            depth += 1
+        elif match.group() == ')':
+            depth -= 1
+        elif depth == 0:
+            predicates.append(condition[start:match.start()])
+            start = match.end()
+    predicates.append(condition[start:])
+    return predicates
+
+
+def find_unrelated_tables(query: str) -> List[str]:
+    """
+    Returns the tables of a comma / CROSS JOIN separated table list which no WHERE predicate relates to another table
+    (i.e. which are joined as cartesian product), e.g. events in: SELECT * FROM patients p, events e WHERE p.a = 1
+    """
+    text = LITERAL_OR_COMMENT_PATTERN.sub("''", query)
+    if len(SELECT_PATTERN.findall(text)) != 1:
+        return []
+    match = TABLE_LIST_PATTERN.search(text)
+    if not match:
+        return []
+
+    # Each table is referred to by its alias or name
+    tables = {normalize_identifier(alias or name): name
+              for name, alias in (TABLE_REFERENCE_PATTERN.fullmatch(reference).groups()
+                                  for reference in re.split(TABLE_SEPARATOR, match.group(1), flags=re.IGNORECASE))}
+    condition = match.group('condition') or ''
+    predicate_qualifiers = [{normalize_identifier(qualifier) for qualifier in QUALIFIER_PATTERN.findall(predicate)}
+                            & tables.keys() for predicate in split_predicates(condition)]
+    if condition.strip() and not any(predicate_qualifiers):
+        # Only unqualified columns, it is unknown which tables they belong to
+        return []
+
+    related = set()
+    for qualifiers in predicate_qualifiers:
+        if len(qualifiers) > 1:
+            related |= qualifiers
+    return [name for key, name in tables.items() if key not in related]
+
+
+def normalize_sql(query: str) -> str:
+    # Only whitespace and trailing semicolons are normalized, the case matters within string literals
+    return ' '.join(query.split()).rstrip(';').rstrip()
+
+
+def get_data_version() -> str:
+    data_hash = ''
+    if os.path.exists(HASH_FILE):
+        with open(HASH_FILE, 'r') as file:
+            data_hash = file.read().strip()
+    return f"{data_hash}-{get_db_file_signature()}"
+
+
+class SqlResultCache:
+    """
+    In-memory LRU cache for query results, keyed by the normalized query text and bounded by the size of the results.
+    All entries are dropped as soon as the data hash or the SQLite DB file changes.
+    """
+
+    def __init__(self, max_size_bytes: int = DEFAULT_MAX_RESULT_CACHE_SIZE_MB * 1024 * 1024):
+        self.max_size_bytes = max_size_bytes
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.data_version = None
+        self.entries: OrderedDict[str, str] = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def entry_size(key: str, result: str) -> int:
+        return len(key.encode('utf-8')) + len(result.encode('utf-8'))
+
+    def invalidate_if_outdated(self):
+        data_version = get_data_version()
+        if data_version != self.data_version:
+            if self.entries:
+                logger.info("Data has changed, dropping all cached SQL query results")
+            self.entries.clear()
+            self.size_bytes = 0
+            self.data_version = data_version
+
+    def get(self, query: str) -> Optional[str]:
+        key = normalize_sql(query)
+        with self.lock:
+            self.invalidate_if_outdated()
+            result = self.entries.get(key)
+            if result is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return result
+
+    def put(self, query: str, result: str):
+        key = normalize_sql(query)
+        size = self.entry_size(key, result)
+        if size > self.max_size_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size_bytes -= self.entry_size(key, self.entries.pop(key))
+            self.entries[key] = result
+            self.size_bytes += size
+            while self.size_bytes > self.max_size_bytes:
+                evicted_key, evicted_result = self.entries.popitem(last=False)
+                self.size_bytes -= self.entry_size(evicted_key, evicted_result)
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': len(self.entries),
+                'size_bytes': self.size_bytes,
+            }
+
+
+class GuardedSqlEngine:
+    def __init__(self, pool_size: int = DEFAULT_POOL_SIZE, timeout_seconds: float = DEFAULT_QUERY_TIMEOUT_SECONDS,
+                 max_rows: int = DEFAULT_MAX_RESULT_ROWS, result_cache: Optional[SqlResultCache] = None):
+        self.timeout_seconds = timeout_seconds
+        self.max_rows = max_rows
+        self.result_cache = result_cache
+        self.pool = queue.Queue()
+        for _ in range(pool_size):
+            self.pool.put(self.connect())
+
+    @staticmethod
+    def connect() -> sqlite3.Connection:
+        # Tool calls are executed on different threads, a connection is only used by one query at a time though
+        conn = sqlite3.connect(f"file:{SQLITE_DB_FILE}?mode=ro", uri=True, check_same_thread=False)
+        conn.execute('PRAGMA query_only = ON')
+        return conn
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        conn = self.pool.get()
+        try:
+            yield conn
+        finally:
+            conn.set_progress_handler(None, 0)
+            self.pool.put(conn)
+
+    def check_query_plan(self, conn: sqlite3.Connection, query: str):
+        plan = conn.execute(f'EXPLAIN QUERY PLAN {query}').fetchall()
+        cartesian_products = find_cartesian_products(plan)
+        if cartesian_products:
+            tables = ', '.join(' x '.join(tables) for tables in cartesian_products)
+            raise QueryRejectedError(f"The query was rejected, because it scans the full cartesian product of {tables}. "
+                                     f"Join the tables on a column (e.g. the patient ID) instead.")
+        # The plan alone doesn't reveal all cartesian products (e.g. if one side is searched via a constant condition)
+        unrelated_tables = find_unrelated_tables(query)
+        if unrelated_tables:
+            raise QueryRejectedError(f"The query was rejected, because no condition relates {', '.join(unrelated_tables)} "
+                                     f"to the other tables (a cartesian product). Join the tables on a column "
+                                     f"(e.g. the patient ID) with JOIN ... ON instead.")
+
+    def execute(self, query: str) -> Tuple[List[tuple], bool]:
+        """Returns the result rows (at most max_rows) and whether the result has been truncated."""
+        with self.connection() as conn:
+            self.check_query_plan(conn, query)
+
+            deadline = time.monotonic() + self.timeout_seconds
+            # A non-zero return value of the progress handler interrupts the running query
+            conn.set_progress_handler(lambda: time.monotonic() > deadline, PROGRESS_HANDLER_INSTRUCTIONS)
+            try:
+                cursor = conn.execute(query)
+                rows = cursor.fetchmany(self.max_rows + 1)
+                cursor.close()
+            except sqlite3.OperationalError as e:
+                if time.monotonic() > deadline:
+                    raise QueryTimeoutError(f"The query was interrupted, because it exceeded the time limit of "
+                                            f"{self.timeout_seconds} seconds. Try a simpler or more selective query.") from e
+                raise
+
+        return rows[:self.max_rows], len(rows) > self.max_rows
+
+    def run(self, query: str) -> str:
+        # Same result format as SQLDatabase.run, plus a marker for truncated results
+        cacheable = self.result_cache is not None and not NON_DETERMINISTIC_PATTERN.search(query)
+        if cacheable:
+            cached_result = self.result_cache.get(query)
+            logger.debug(f"SQL result cache: {self.result_cache.stats()}")
+            if cached_result is not None:
+                return cached_result
+
+        start_time = time.time()
+        rows, truncated = self.execute(query)
+        logger.debug(f"SQL query returned {len(rows)} rows{' (truncated)' if truncated else ''} "
+                     f"in {(time.time() - start_time) * 1000:.1f} ms")
+        result = str(rows) if rows else ''
+        if truncated:
+            result += '\n' + TRUNCATED_MARKER.format(max_rows=self.max_rows)
+
+        if cacheable:
+            self.result_cache.put(query, result)
+        return result
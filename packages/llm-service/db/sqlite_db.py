@@ -1,42 +1,288 @@
 import logging
 import os
 import sqlite3
+import time
+from contextlib import closing
+from typing import Optional, Dict
 
 import pandas as pd
 from langchain.sql_database import SQLDatabase
 from langchain_community.vectorstores import Chroma
 
-from db.clustering import calc_2d_and_clusters
-from db.data_dir_contents import SQLITE_DB_FILE
-from db.data_frames import concat_coordinates_and_cluster_to_patients
-from db.shared import LoadedDataFrames
+from db.clustering import calc_2d_and_clusters, place_patients, calc_drift, is_refit_needed, is_refit_requested, \
+    save_refit_token
+from db.data_dir_contents import SQLITE_DB_FILE, SCHEMA_FILE
+from db.data_frames import concat_coordinates_and_cluster_to_patients, format_dates, PATIENT_ID_COLUMN_NAME, \
+    EVENT_ID_COLUMN_NAME, COLUMN_TYPES_ATTR
+from db.manifest import ManifestDiff, has_changes
+from db.shared import LoadedDataFrames, COORDINATES_AND_CLUSTER_COLUMN_NAMES, COORDINATES_AND_CLUSTER_COLUMN_TYPES
+from db.sqlite_queries import quote
 
 logger = logging.getLogger(__name__)
 
+# Durability is not needed while building the database from scratch (in a temporary file, see prepare_sql_db)
+BUILD_PRAGMAS = [
+    'journal_mode = OFF',
+    'synchronous = OFF',
+    'temp_store = MEMORY',
+    'cache_size = -262144',  # 256 MB
+]
+
+# Columns of these PJ types are indexed (besides the primary keys)
+INDEXED_COLUMN_TYPES = {'pid', 'eid', 'timestamp', 'date', 'category'}
+
+# Columns with at most this many distinct values are summarized with value examples
+MAX_DISTINCT_VALUES_FOR_EXAMPLES = 25
+MAX_VALUE_EXAMPLES = 8
+
+# The column summary is computed on at most this many (evenly spaced) rows per table: Distinct counts & grouping of all
+# rows of large tables with free-text columns would delay the startup by minutes
+MAX_ROWS_FOR_COLUMN_SUMMARY = 100000
+
+
+def align_to_patients(patients_df: pd.DataFrame, coordinates_and_clusters_df: pd.DataFrame) -> pd.DataFrame:
+    # Coordinates & clusters are indexed by patient ID, bring them into the order of the patients data frame
+    return coordinates_and_clusters_df.reindex(patients_df[PATIENT_ID_COLUMN_NAME]).reset_index(drop=True)
+
+
+def get_sqlite_column_type(series: pd.Series) -> str:
+    if pd.api.types.is_bool_dtype(series) or pd.api.types.is_integer_dtype(series):
+        return 'INTEGER'
+    if pd.api.types.is_float_dtype(series):
+        return 'REAL'
+    return 'TEXT'
+
+
+def create_table(conn: sqlite3.Connection, table: str, df: pd.DataFrame, primary_key: str, foreign_keys: str = ''):
+    column_definitions = [f'{quote(column)} {get_sqlite_column_type(df[column])}' for column in df.columns]
+    conn.execute(f'DROP TABLE IF EXISTS {quote(table)}')
+    conn.execute(f'CREATE TABLE {quote(table)} ({", ".join(column_definitions)}, '
+                 f'PRIMARY KEY ({quote(primary_key)}){foreign_keys})')
+
+
+def insert_rows(conn: sqlite3.Connection, table: str, df: pd.DataFrame):
+    placeholders = ', '.join('?' * len(df.columns))
+    # itertuples yields native Python values, NaN values are stored as NULL by SQLite
+    conn.executemany(f'INSERT INTO {quote(table)} VALUES ({placeholders})', df.itertuples(index=False, name=None))
+
+
+def create_indexes(conn: sqlite3.Connection, table: str, column_types: Dict[str, str], primary_key: str):
+    for column, column_type in column_types.items():
+        if column_type in INDEXED_COLUMN_TYPES and column != primary_key:
+            conn.execute(f'CREATE INDEX {quote(f"{table}_{column}_idx")} ON {quote(table)} ({quote(column)})')
+
 
 def prepare_sql_db(data_frames: LoadedDataFrames, coordinates_and_clusters_df: pd.DataFrame):
-    # Create a connection to a new SQLite database
-    conn = sqlite3.connect(SQLITE_DB_FILE)
+    start_time = time.time()
+
+    # The database is built in a temporary file and only moved into place when complete: A failed or interrupted
+    # build never leaves a partial database behind, so durability can be traded for speed while loading
+    temporary_path = f'{SQLITE_DB_FILE}.{os.getpid()}.tmp'
+    if os.path.exists(temporary_path):
+        os.remove(temporary_path)
+    conn = sqlite3.connect(temporary_path, isolation_level=None)
+    try:
+        build_sql_db(conn, data_frames, coordinates_and_clusters_df)
+        conn.close()
+    except BaseException:
+        conn.close()
+        os.remove(temporary_path)
+        raise
+    os.replace(temporary_path, SQLITE_DB_FILE)
+
+    logger.info(f"SQLite database has been created with patients and events tables in {time.time() - start_time:.1f} seconds.")
+
+
+def build_sql_db(conn: sqlite3.Connection, data_frames: LoadedDataFrames, coordinates_and_clusters_df: pd.DataFrame):
+    for pragma in BUILD_PRAGMAS:
+        conn.execute(f'PRAGMA {pragma}')
+
+    patients_df = data_frames['patients']
+    patients_clustered_df = concat_coordinates_and_cluster_to_patients(
+        patients_df, align_to_patients(patients_df, coordinates_and_clusters_df))
+    events_df = data_frames['events']
+
+    patient_column_types = {**patients_df.attrs.get(COLUMN_TYPES_ATTR, {}),
+                            **dict(zip(COORDINATES_AND_CLUSTER_COLUMN_NAMES, COORDINATES_AND_CLUSTER_COLUMN_TYPES))}
+    event_column_types = events_df.attrs.get(COLUMN_TYPES_ATTR, {})
+
+    # Write the data from pandas DataFrames to the SQLite database (in a single transaction)
+    conn.execute('BEGIN')
+    create_table(conn, 'patients', patients_clustered_df, primary_key=PATIENT_ID_COLUMN_NAME)
+    create_table(conn, 'events', events_df, primary_key=EVENT_ID_COLUMN_NAME,
+                 foreign_keys=f', FOREIGN KEY ({quote(PATIENT_ID_COLUMN_NAME)}) '
+                              f'REFERENCES patients ({quote(PATIENT_ID_COLUMN_NAME)})')
+    insert_rows(conn, 'patients', format_dates(patients_clustered_df))
+    insert_rows(conn, 'events', format_dates(events_df))
 
-    # Write the data from pandas DataFrames to the SQLite database
+    # Indexes are created after loading, which is faster than maintaining them during the inserts
+    create_indexes(conn, 'patients', patient_column_types, primary_key=PATIENT_ID_COLUMN_NAME)
+    create_indexes(conn, 'events', event_column_types, primary_key=EVENT_ID_COLUMN_NAME)
+    conn.execute('COMMIT')
 
+    # Collect statistics for the query planner
+    conn.execute('ANALYZE')
+
+    log_query_latencies(conn, patients_clustered_df, event_column_types)
+
+
+def log_query_latencies(conn: sqlite3.Connection, patients_df: pd.DataFrame, event_column_types: Dict[str, str]):
+    if patients_df.empty:
+        return
+
+    pid = patients_df[PATIENT_ID_COLUMN_NAME].iloc[0]
+    cluster_column = COORDINATES_AND_CLUSTER_COLUMN_NAMES[2]
+    typical_queries = {
+        'events of a patient': (f'SELECT * FROM events WHERE {quote(PATIENT_ID_COLUMN_NAME)} = ?', [pid]),
+        'events per cluster': (f'SELECT p.{quote(cluster_column)}, COUNT(*) FROM patients p JOIN events e '
+                               f'ON e.{quote(PATIENT_ID_COLUMN_NAME)} = p.{quote(PATIENT_ID_COLUMN_NAME)} GROUP BY 1', []),
+    }
+    for column, column_type in event_column_types.items():
+        if column_type == 'category':
+            typical_queries[f'events per "{column}"'] = (f'SELECT {quote(column)}, COUNT(*) FROM events GROUP BY 1', [])
+            break
+
+    for name, (sql, params) in typical_queries.items():
+        start_time = time.time()
+        conn.execute(sql, params).fetchall()
+        logger.info(f"  -> Query latency ({name}): {(time.time() - start_time) * 1000:.1f} ms")
+
+
+def refresh_sql_db(data_frames: LoadedDataFrames, vector_store: Chroma, diff: ManifestDiff):
+    with closing(sqlite3.connect(SQLITE_DB_FILE)) as conn:
+        is_refreshed = refresh_rows(conn, data_frames, vector_store, diff)
+    # Otherwise the whole map is recalculated (after the connection to the current database has been closed)
+    if not is_refreshed:
+        prepare_sql_db(data_frames, calc_2d_and_clusters(vector_store))
+
+
+def refresh_rows(conn: sqlite3.Connection, data_frames: LoadedDataFrames, vector_store: Chroma, diff: ManifestDiff) -> bool:
+    """Replaces the rows of the added, changed & removed patients. Returns False if the map needs to be recalculated."""
     patients_df = data_frames['patients']
-    patients_clustered_df = concat_coordinates_and_cluster_to_patients(patients_df, coordinates_and_clusters_df)
-    patients_clustered_df.to_sql('patients', conn, if_exists='replace', index=False)
+    existing_columns = [row[1] for row in conn.execute('PRAGMA table_info(patients)')]
+    if existing_columns != patients_df.columns.tolist() + COORDINATES_AND_CLUSTER_COLUMN_NAMES:
+        raise ValueError("The patient columns have changed, please delete the SQLite data file and restart the service.")
+
+    affected_pids = diff['added'] | diff['changed']
+    pids_to_delete = affected_pids | diff['removed']
+
+    # Place added & changed patients relative to the unchanged ones
+    coordinates_and_clusters_df = pd.read_sql(
+        'SELECT ' + ', '.join(f'"{col}"' for col in [PATIENT_ID_COLUMN_NAME, *COORDINATES_AND_CLUSTER_COLUMN_NAMES]) + ' FROM patients',
+        conn, index_col=PATIENT_ID_COLUMN_NAME)
+    unchanged_df = coordinates_and_clusters_df.drop(index=list(pids_to_delete), errors='ignore')
+    if unchanged_df.empty:
+        # Nothing to place the patients relative to
+        return False
+    if affected_pids:
+        placed_df = place_patients(vector_store, unchanged_df, affected_pids)
+    else:
+        placed_df = unchanged_df.iloc[0:0]
+
+    if is_refit_needed(calc_drift(pd.concat([unchanged_df, placed_df]))):
+        # The placed patients no longer fit the map, so it is recalculated (and the models refitted)
+        logger.info("Clustering drift exceeds its threshold, the 2D map & clusters are refitted")
+        return False
 
+    affected_patients_df = patients_df[patients_df[PATIENT_ID_COLUMN_NAME].isin(affected_pids)]
+    affected_patients_df = concat_coordinates_and_cluster_to_patients(
+        affected_patients_df.reset_index(drop=True), align_to_patients(affected_patients_df, placed_df))
     events_df = data_frames['events']
-    events_df.to_sql('events', conn, if_exists='replace', index=False)
+    affected_events_df = events_df[events_df[PATIENT_ID_COLUMN_NAME].isin(affected_pids)]
 
-    # Close the connection to the database
-    conn.close()
+    # Replace the rows of all affected patients
+    with conn:
+        pid_params = [(pid,) for pid in pids_to_delete]
+        conn.executemany(f'DELETE FROM patients WHERE "{PATIENT_ID_COLUMN_NAME}" = ?', pid_params)
+        conn.executemany(f'DELETE FROM events WHERE "{PATIENT_ID_COLUMN_NAME}" = ?', pid_params)
+        format_dates(affected_patients_df).to_sql('patients', conn, if_exists='append', index=False)
+        format_dates(affected_events_df).to_sql('events', conn, if_exists='append', index=False)
 
-    logger.info("SQLite database has been created with patients and events tables.")
+    # Update the statistics for the query planner, as after building the database
+    conn.execute('ANALYZE')
+
+    logger.info(f"SQLite database has been refreshed: {len(diff['added'])} added, {len(diff['changed'])} changed, "
+                f"{len(diff['removed'])} removed patients.")
+    return True
 
 
 # Check if the patient journey reports have already been prepared and are plausible
-def init_sqlite_db(data_frames: LoadedDataFrames, vector_store: Chroma) -> SQLDatabase:
-    if not os.path.exists(SQLITE_DB_FILE):
+def init_sqlite_db(data_frames: LoadedDataFrames, vector_store: Chroma, diff: Optional[ManifestDiff] = None) -> SQLDatabase:
+    # A refit can be requested explicitly, e.g. after many small refreshes (CLUSTERING_REFIT=<any new value>)
+    if not os.path.exists(SQLITE_DB_FILE) or is_refit_requested():
         coordinates_and_clusters_df = calc_2d_and_clusters(vector_store)
         prepare_sql_db(data_frames, coordinates_and_clusters_df)
+        # Only stored once the database has been written, so a failed refit is repeated on the next start
+        save_refit_token()
+    elif has_changes(diff):
+        refresh_sql_db(data_frames, vector_store, diff)
 
     return SQLDatabase.from_uri(f"sqlite:///{SQLITE_DB_FILE}")
+
+
+def describe_columns(conn: sqlite3.Connection, table: str) -> str:
+    row_count = conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0]
+    rows = f'"{table}"'
+    sample_note = ''
+    if row_count > MAX_ROWS_FOR_COLUMN_SUMMARY:
+        # Every n-th row ID is looked up (instead of scanning the whole table)
+        max_rowid = conn.execute(f'SELECT MAX(rowid) FROM "{table}"').fetchone()[0]
+        step = -(-max_rowid // MAX_ROWS_FOR_COLUMN_SUMMARY)
+        rows = (f'(SELECT * FROM "{table}" WHERE rowid IN (WITH RECURSIVE sample(id) AS (SELECT 1 UNION ALL '
+                f'SELECT id + {step} FROM sample WHERE id + {step} <= {max_rowid}) SELECT id FROM sample))')
+        sample_note = f', summarized on an evenly spaced sample of at most {MAX_ROWS_FOR_COLUMN_SUMMARY} rows'
+    lines = [f"Column summary for table {table} ({row_count} rows{sample_note}):"]
+    for _, column, column_type, *_ in conn.execute(f'PRAGMA table_info("{table}")').fetchall():
+        distinct_count, sample_count = conn.execute(f'SELECT COUNT(DISTINCT "{column}"), COUNT(*) FROM {rows}').fetchone()
+        line = f'"{column}" {column_type}: {distinct_count} distinct values'
+        if distinct_count <= MAX_DISTINCT_VALUES_FOR_EXAMPLES and distinct_count < sample_count:
+            # Category-like column (values repeat), list the most common values
+            examples = conn.execute(
+                f'SELECT "{column}", COUNT(*) FROM {rows} GROUP BY 1 ORDER BY 2 DESC LIMIT {MAX_VALUE_EXAMPLES}').fetchall()
+            line += ', e.g. ' + ', '.join(f'{value!r} ({count})' for value, count in examples)
+        elif column_type in ('INTEGER', 'REAL'):
+            min_value, max_value = conn.execute(f'SELECT MIN("{column}"), MAX("{column}") FROM {rows}').fetchone()
+            line += f', range {min_value} to {max_value}'
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def get_db_file_signature() -> str:
+    stat = os.stat(SQLITE_DB_FILE)
+    return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+
+class SchemaDescription:
+    """
+    The schema text used in the agent prompt (table definitions, sample rows & a compact column summary).
+    It is computed once and persisted next to the SQLite file, and only recomputed when the SQLite file changes.
+    """
+
+    def __init__(self, sqlite_db: SQLDatabase):
+        self.sqlite_db = sqlite_db
+        self.signature = None
+        self.text = None
+
+    def get(self) -> str:
+        signature = get_db_file_signature()
+        if signature != self.signature:
+            self.text = self.load(signature) or self.create(signature)
+            self.signature = signature
+        return self.text
+
+    def load(self, signature: str) -> Optional[str]:
+        if not os.path.exists(SCHEMA_FILE):
+            return None
+        with open(SCHEMA_FILE, 'r', encoding='utf-8') as file:
+            stored_signature, text = file.read().split('\n', 1)
+        return text if stored_signature == signature else None
+
+    def create(self, signature: str) -> str:
+        start_time = time.time()
+        with closing(sqlite3.connect(SQLITE_DB_FILE)) as conn:
+            column_summaries = [describe_columns(conn, table) for table in self.sqlite_db.get_usable_table_names()]
+        text = self.sqlite_db.get_table_info() + '\n\n/*\n' + '\n\n'.join(column_summaries) + '\n*/'
+        with open(SCHEMA_FILE, 'w', encoding='utf-8') as file:
+            file.write(f"{signature}\n{text}")
+        logger.info(f"SQLite schema description has been created in {time.time() - start_time:.1f} seconds")
+        return text
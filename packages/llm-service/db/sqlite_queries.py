@@ -0,0 +1,104 @@
+import json
+import sqlite3
+from typing import List, Optional, Any, Tuple, Iterator, TypedDict
+
+from db.data_dir_contents import SQLITE_DB_FILE
+from db.data_frames import PATIENT_ID_COLUMN_NAME
+
+# Paginated, filterable read access to the patients & events tables.
+# Pagination uses the rowid as cursor (keyset pagination), so every page is an index range scan.
+
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10000
+
+FETCH_BATCH_SIZE = 500
+
+COMPARISON_OPERATORS = {
+    'eq': '=',
+    'ne': '!=',
+    'lt': '<',
+    'lte': '<=',
+    'gt': '>',
+    'gte': '>=',
+}
+
+
+class Filter(TypedDict):
+    column: str
+    op: str  # One of COMPARISON_OPERATORS or 'in'
+    value: Any
+
+
+class InvalidQueryError(ValueError):
+    pass
+
+
+def connect_read_only() -> sqlite3.Connection:
+    # Rows are streamed from worker threads, hence check_same_thread=False (a connection is only used by one request)
+    return sqlite3.connect(f"file:{SQLITE_DB_FILE}?mode=ro", uri=True, check_same_thread=False)
+
+
+def get_columns(conn: sqlite3.Connection, table: str) -> List[str]:
+    return [row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')]
+
+
+def quote(column: str) -> str:
+    return '"' + column.replace('"', '""') + '"'
+
+
+def build_query(table: str, table_columns: List[str], columns: Optional[List[str]], filters: List[Filter],
+                pids: Optional[List[str]], cursor: Optional[str], limit: int) -> Tuple[str, List[Any], List[str]]:
+    """Returns the SQL, its parameters and the selected (projected) columns."""
+    selected_columns = columns or table_columns
+    unknown_columns = [column for column in [*selected_columns, *(f['column'] for f in filters)] if column not in table_columns]
+    if unknown_columns:
+        raise InvalidQueryError(f"Unknown columns for table {table}: {unknown_columns}")
+
+    conditions = []
+    params = []
+    for f in filters:
+        if f['op'] == 'in':
+            if not isinstance(f['value'], list):
+                raise InvalidQueryError(f"Filter value for 'in' on column {f['column']} must be a list")
+            # json_each avoids SQLite's limit on the number of host parameters
+            conditions.append(f"{quote(f['column'])} IN (SELECT value FROM json_each(?))")
+            params.append(json.dumps(f['value']))
+        elif f['op'] in COMPARISON_OPERATORS:
+            if not isinstance(f['value'], (str, int, float)):
+                raise InvalidQueryError(f"Filter value for '{f['op']}' on column {f['column']} must be a string or number")
+            conditions.append(f"{quote(f['column'])} {COMPARISON_OPERATORS[f['op']]} ?")
+            params.append(f['value'])
+        else:
+            raise InvalidQueryError(f"Unknown filter operator: {f['op']}")
+
+    if pids is not None:
+        conditions.append(f"{quote(PATIENT_ID_COLUMN_NAME)} IN (SELECT value FROM json_each(?))")
+        params.append(json.dumps(pids))
+
+    if cursor is not None:
+        try:
+            params.append(int(cursor))
+        except ValueError:
+            raise InvalidQueryError(f"Invalid cursor: {cursor}")
+        conditions.append('rowid > ?')
+
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ''
+    # One more row than requested is fetched to find out whether there is a next page
+    sql = f"SELECT rowid, {', '.join(quote(c) for c in selected_columns)} FROM {quote(table)}{where} ORDER BY rowid LIMIT ?"
+    params.append(limit + 1)
+    return sql, params, selected_columns
+
+
+def execute_query(conn: sqlite3.Connection, sql: str, params: List[Any]) -> Tuple[sqlite3.Cursor, List[tuple]]:
+    """
+    Executes the query and fetches the first batch eagerly, so errors are raised before a response is started.
+    """
+    rows = conn.execute(sql, params)
+    return rows, rows.fetchmany(FETCH_BATCH_SIZE)
+
+
+def stream_rows(rows: sqlite3.Cursor, first_batch: List[tuple]) -> Iterator[tuple]:
+    batch = first_batch
+    while batch:
+        yield from batch
+        batch = rows.fetchmany(FETCH_BATCH_SIZE)
@@ -0,0 +1,54 @@
+import os
+import tempfile
+import unittest
+
+from db.data_frames import load_df
+from db.prepare_patient_journeys import create_render_chunks, render_patient_journeys
+
+PATIENTS_CSV = """Patient ID,Name,Date Of Birth,Height
+pid,string,date,number
+001,Lucas,15.08.1987,174
+002,Ana,,160
+"""
+
+EVENTS_CSV = """Event ID,Patient ID,Date,Description
+eid,pid,date,string
+e001,001,01.02.2020,Admission
+e002,002,31.12.2021,Discharge
+"""
+
+# The reports as rendered from the raw text of the input files (before load_df kept the parsed dates)
+EXPECTED_REPORTS = (
+    "001 Patient information:          Patient ID: 001          Name: Lucas          Date Of Birth: 15.08.1987"
+    "          Height: 174.0           The patients' journey through the hospital:          Event 1:"
+    "          Event ID: e001          Patient ID: 001          Date: 01.02.2020          Description: Admission\n"
+    "002 Patient information:          Patient ID: 002          Name: Ana          Date Of Birth: nan"
+    "          Height: 160.0           The patients' journey through the hospital:          Event 1:"
+    "          Event ID: e002          Patient ID: 002          Date: 31.12.2021          Description: Discharge\n"
+)
+
+
+class RenderPatientJourneysTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def load_fixture(self, name: str, content: str):
+        file_path = os.path.join(self.directory.name, name)
+        with open(file_path, 'w') as file:
+            file.write(content)
+        return load_df(file_path)
+
+    def test_dates_are_rendered_as_in_the_input_files(self):
+        data_frames = {'patients': self.load_fixture('patients.csv', PATIENTS_CSV),
+                       'events': self.load_fixture('events.csv', EVENTS_CSV)}
+        # load_df keeps the parsed dates, the reports must not change because of it
+        self.assertEqual(data_frames['patients']['Date Of Birth'].dtype.kind, 'M')
+
+        reports = ''.join(render_patient_journeys(chunk) for chunk in create_render_chunks(data_frames))
+
+        self.assertEqual(reports.encode('utf-8'), EXPECTED_REPORTS.encode('utf-8'))
+
+
+if __name__ == '__main__':
+    unittest.main()
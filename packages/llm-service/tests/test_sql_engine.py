@@ -0,0 +1,70 @@
+import sqlite3
+import unittest
+
+from db.sql_engine import find_cartesian_products, find_unrelated_tables
+
+SCHEMA = """
+CREATE TABLE patients ("Patient ID" TEXT PRIMARY KEY, "Name" TEXT, "Height" REAL);
+CREATE TABLE events ("Event ID" TEXT PRIMARY KEY, "Patient ID" TEXT, "Description" TEXT);
+CREATE INDEX events_pid_idx ON events ("Patient ID");
+"""
+
+
+class FindUnrelatedTablesTest(unittest.TestCase):
+    def assertUnrelated(self, query: str, tables: list):
+        self.assertEqual(find_unrelated_tables(query), tables, query)
+
+    def test_tables_without_a_join_condition_are_reported(self):
+        self.assertUnrelated('SELECT * FROM patients p, events e WHERE p."Height" > 170', ['patients', 'events'])
+        self.assertUnrelated('SELECT * FROM patients p, events e WHERE p.Name = 1 AND e."Description" = \'x\'',
+                             ['patients', 'events'])
+        self.assertUnrelated('SELECT count(*) FROM patients CROSS JOIN events', ['patients', 'events'])
+        self.assertUnrelated('SELECT * FROM patients AS p, events AS e, events AS f '
+                             'WHERE p."Patient ID" = e."Patient ID" ORDER BY 1', ['events'])
+
+    def test_join_conditions_are_recognized(self):
+        self.assertUnrelated('SELECT * FROM patients p, events e WHERE p."Patient ID" = e."Patient ID"', [])
+        self.assertUnrelated('SELECT * FROM patients, events WHERE patients."Patient ID" = events."Patient ID" LIMIT 5',
+                             [])
+
+    def test_no_false_positives(self):
+        queries = [
+            # Join conditions with IN, LIKE or functions
+            'SELECT * FROM patients p, events e WHERE e."Patient ID" IN (p."Patient ID", p."Name")',
+            'SELECT * FROM patients p, events e WHERE e."Description" LIKE \'%\' || p."Name" || \'%\'',
+            'SELECT * FROM patients p, events e WHERE lower(p."Patient ID") = lower(e."Patient ID") AND p.Height > 1',
+            'SELECT * FROM patients p, events e WHERE (p."Patient ID" = e."Patient ID" OR p.Name = e.Description)',
+            # Joins with ON / USING
+            'SELECT * FROM patients p JOIN events e ON p."Patient ID" = e."Patient ID" WHERE p."Height" > 170',
+            'SELECT * FROM patients JOIN events USING ("Patient ID")',
+            # Subqueries & CTEs (left to the query plan check)
+            'SELECT * FROM patients p WHERE p."Patient ID" IN (SELECT "Patient ID" FROM events, patients)',
+            'WITH e AS (SELECT * FROM events) SELECT * FROM patients p, e WHERE p."Patient ID" = e."Patient ID"',
+            # A single table, commas & keywords in literals or comments
+            'SELECT "Name", "Height" FROM patients WHERE "Name" = \'a, b\'',
+            'SELECT * FROM patients -- , events\nWHERE "Height" > 1',
+            # Unqualified columns (it is unknown which table they belong to)
+            'SELECT * FROM patients p, events e WHERE "Name" = "Description"',
+        ]
+        for query in queries:
+            self.assertUnrelated(query, [])
+
+
+class FindCartesianProductsTest(unittest.TestCase):
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        self.addCleanup(self.conn.close)
+        self.conn.executescript(SCHEMA)
+
+    def find(self, query: str):
+        return find_cartesian_products(self.conn.execute(f'EXPLAIN QUERY PLAN {query}').fetchall())
+
+    def test_sibling_full_scans_are_reported(self):
+        self.assertEqual(self.find('SELECT * FROM patients, events'), [['patients', 'events']])
+
+    def test_indexed_joins_are_accepted(self):
+        self.assertEqual(self.find('SELECT * FROM patients p JOIN events e ON p."Patient ID" = e."Patient ID"'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
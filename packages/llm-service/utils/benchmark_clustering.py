@@ -0,0 +1,52 @@
+import multiprocessing
+import resource
+import sys
+import tempfile
+import time
+from typing import Tuple
+
+import numpy as np
+from langchain_community.vectorstores import Chroma
+from sklearn.metrics import adjusted_rand_score
+
+from db.clustering import reduce_dimensionality, create_clusters, CLUSTERING_PIPELINES
+from db.data_dir_contents import CHROMA_PERSIST_DIR
+
+# Compare wall time, peak memory and the resulting clusters of the clustering pipelines (exact & large)
+# Each pipeline runs in a fresh process, so its peak RSS is not distorted by the other one. The clusters are compared
+# by the adjusted Rand index (1 = identical partitions, ~0 = random agreement).
+# To run: (from inside packages/llm-service) `poetry run python utils/benchmark_clustering.py [<max nr of patients>]`
+
+
+def run_pipeline(embeddings_file: str, pipeline: str) -> Tuple[float, float, np.ndarray]:
+    embeddings = np.load(embeddings_file)
+    start_time = time.perf_counter()
+    _, coordinates = reduce_dimensionality(embeddings, pipeline)
+    _, clusters = create_clusters(coordinates, pipeline)
+    seconds = time.perf_counter() - start_time
+    # ru_maxrss is in kilobytes on Linux (bytes on macOS)
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    return seconds, peak_rss_mb, clusters
+
+
+if __name__ == "__main__":
+    # Only the already stored embeddings are read, so no embedding function is needed
+    vector_store = Chroma(persist_directory=CHROMA_PERSIST_DIR)
+    # The embeddings are passed as float64 (like in calc_2d_and_clusters), the large pipeline casts them itself
+    embeddings = np.array(vector_store.get(include=['embeddings'])['embeddings'], dtype=np.float64)
+    if len(sys.argv) > 1 and int(sys.argv[1]) < len(embeddings):
+        embeddings = embeddings[np.random.default_rng(0).choice(len(embeddings), int(sys.argv[1]), replace=False)]
+    print(f"{len(embeddings)} patients, {embeddings.shape[1]} dimensions")
+
+    clusters_by_pipeline = {}
+    with tempfile.NamedTemporaryFile(suffix='.npy') as file:
+        np.save(file.name, embeddings)
+        context = multiprocessing.get_context('spawn')
+        for clustering_pipeline in CLUSTERING_PIPELINES:
+            with context.Pool(1) as pool:
+                wall_seconds, peak_rss, clusters_by_pipeline[clustering_pipeline] = pool.apply(
+                    run_pipeline, (file.name, clustering_pipeline))
+            print(f"{clustering_pipeline:>6}: {wall_seconds:.1f} s, peak RSS {peak_rss:.0f} MB")
+
+    agreement = adjusted_rand_score(*(clusters_by_pipeline[pipeline] for pipeline in CLUSTERING_PIPELINES))
+    print(f"Cluster agreement (adjusted Rand index): {agreement:.3f}")
@@ -0,0 +1,66 @@
+import random
+import statistics
+import time
+from typing import List, Tuple, Set
+
+from db.bm25_index import init_bm25_index, tokenize, BM25Index
+from db.chroma_db import init_chroma_db, PID_METADATA_FIELD_NAME
+from db.data_dir_contents import PATIENT_REPORTS_TXT
+from db.hybrid_search import HybridSearch, RETRIEVAL_MODES
+
+# Compare latency and recall of the retrieval modes (vector = the Chroma-only path, lexical, hybrid)
+# The queries are rare terms (e.g. codes or drug names) of randomly selected patient journeys, the relevant
+# journeys of a query are all journeys containing its term.
+# To run: (from inside packages/llm-service) `poetry run python utils/benchmark_retrieval.py`
+
+NR_OF_QUERIES = 50
+K = 5
+
+# Only terms occurring in at most this many journeys are used as queries
+MAX_DOCUMENT_FREQUENCY = 20
+MIN_TERM_LENGTH = 4
+
+
+def create_queries(index: BM25Index, reports: List[str], count: int) -> List[Tuple[str, Set[str]]]:
+    queries = []
+    for doc_index in random.sample(range(len(reports)), min(count, len(reports))):
+        candidates = []
+        for term in sorted(set(tokenize(reports[doc_index]))):
+            if len(term) >= MIN_TERM_LENGTH and not term.isdigit() and len(get_postings(index, term)) <= MAX_DOCUMENT_FREQUENCY:
+                candidates.append(term)
+        if candidates:
+            term = random.choice(candidates)
+            queries.append((term, set(index.pids[get_postings(index, term)].tolist())))
+    return queries
+
+
+def get_postings(index: BM25Index, term: str):
+    term_id = index.term_ids[term]
+    return index.doc_indices[index.offsets[term_id]:index.offsets[term_id + 1]]
+
+
+def benchmark(search: HybridSearch, queries: List[Tuple[str, Set[str]]], mode: str):
+    latencies = []
+    recalls = []
+    for query, relevant_pids in queries:
+        start_time = time.perf_counter()
+        docs = search.search(query, K, mode=mode)
+        latencies.append((time.perf_counter() - start_time) * 1000)
+        retrieved_pids = {doc.metadata[PID_METADATA_FIELD_NAME] for doc in docs}
+        recalls.append(len(retrieved_pids & relevant_pids) / min(K, len(relevant_pids)))
+    latencies.sort()
+    print(f"{mode:>8}: recall@{K} {statistics.mean(recalls):.3f} – latency mean {statistics.mean(latencies):.1f} ms, "
+          f"p50 {latencies[len(latencies) // 2]:.1f} ms, p95 {latencies[int(len(latencies) * 0.95)]:.1f} ms")
+
+
+if __name__ == "__main__":
+    random.seed(0)
+    lexical_index = init_bm25_index()
+    with open(PATIENT_REPORTS_TXT, 'r', encoding='utf-8') as file:
+        patient_reports = file.readlines()
+    vector_store = init_chroma_db(len(lexical_index.pids))
+    search = HybridSearch(vector_store, lexical_index)
+    benchmark_queries = create_queries(lexical_index, patient_reports, NR_OF_QUERIES)
+    print(f"{len(benchmark_queries)} queries, {len(lexical_index.pids)} patient journeys")
+    for retrieval_mode in RETRIEVAL_MODES:
+        benchmark(search, benchmark_queries, retrieval_mode)
@@ -0,0 +1,21 @@
+import fcntl
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+
+@contextmanager
+def file_lock(file_path: str, on_wait: Callable[[], None] = lambda: None) -> Iterator[None]:
+    """
+    Exclusive lock (across processes) on the given file, released when the block is left or the process exits.
+    on_wait is called before blocking, if another process holds the lock.
+    """
+    with open(file_path, 'a') as file:
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            on_wait()
+            fcntl.flock(file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
@@ -0,0 +1,138 @@
+import gzip
+import hashlib
+import logging
+import os
+import shutil
+from typing import Dict, Optional, Union
+
+from utils.hash import calculate_hash
+
+try:
+    import brotli
+except ImportError:  # Brotli is optional, gzip is always available
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# Content encodings in order of preference
+PREFERRED_ENCODINGS = ['br', 'gzip', 'identity']
+
+# Large files are compressed with faster settings than in-memory content
+FILE_GZIP_LEVEL = 6
+FILE_BROTLI_QUALITY = 5
+FILE_CHUNK_SIZE = 1024 * 1024
+
+
+class Precompressed:
+    """
+    Content together with its gzip (and – if available – brotli) compressed representations.
+    Every representation has its own strong ETag, derived from a hash of the content.
+    """
+
+    hash: str
+    representations: Dict[str, Union[bytes, str]]
+
+    def etag(self, encoding: str) -> str:
+        return f'"{self.hash}"' if encoding == 'identity' else f'"{self.hash}-{encoding}"'
+
+    def select_encoding(self, accept_encoding: Optional[str]) -> str:
+        accepted = parse_accept_encoding(accept_encoding)
+        for encoding in PREFERRED_ENCODINGS:
+            if encoding in self.representations and accepted.get(encoding, accepted.get('*', 0)) > 0:
+                return encoding
+        return 'identity'
+
+
+class PrecompressedContent(Precompressed):
+    """In-memory content, the representations are bytes."""
+
+    def __init__(self, content: bytes):
+        self.hash = hashlib.md5(content).hexdigest()
+        self.representations = {
+            'identity': content,
+            'gzip': gzip.compress(content, compresslevel=9, mtime=0),
+        }
+        if brotli is not None:
+            self.representations['br'] = brotli.compress(content)
+
+
+class PrecompressedFile(Precompressed):
+    """
+    A file on disk, the representations are file paths.
+    Compressed representations are created once in the cache directory and named by the content hash,
+    so they are only recreated when the content changes.
+    """
+
+    def __init__(self, file_path: str, cache_dir: str):
+        self.hash = calculate_hash(file_path)
+        self.representations = {'identity': file_path}
+
+        os.makedirs(cache_dir, exist_ok=True)
+        base_name = os.path.basename(file_path)
+        remove_outdated_representations(cache_dir, base_name, self.hash)
+        cache_path = os.path.join(cache_dir, f"{base_name}.{self.hash}")
+        self.representations['gzip'] = compress_file(file_path, cache_path + '.gz', gzip_file)
+        if brotli is not None:
+            self.representations['br'] = compress_file(file_path, cache_path + '.br', brotli_file)
+
+    def size(self, encoding: str) -> int:
+        return os.path.getsize(self.representations[encoding])
+
+
+def remove_outdated_representations(cache_dir: str, base_name: str, content_hash: str):
+    for file_name in os.listdir(cache_dir):
+        if file_name.startswith(base_name + '.') and not file_name.startswith(f"{base_name}.{content_hash}."):
+            os.remove(os.path.join(cache_dir, file_name))
+
+
+def compress_file(source_path: str, target_path: str, compress) -> str:
+    if not os.path.exists(target_path):
+        logger.info(f"Compressing {source_path} to {target_path}...")
+        # Write to a temporary file first, so an interrupted run never leaves a truncated representation behind
+        temporary_path = target_path + '.tmp'
+        compress(source_path, temporary_path)
+        os.replace(temporary_path, target_path)
+    return target_path
+
+
+def gzip_file(source_path: str, target_path: str):
+    with open(source_path, 'rb') as source, gzip.GzipFile(target_path, 'wb', compresslevel=FILE_GZIP_LEVEL, mtime=0) as target:
+        shutil.copyfileobj(source, target, FILE_CHUNK_SIZE)
+
+
+def brotli_file(source_path: str, target_path: str):
+    compressor = brotli.Compressor(quality=FILE_BROTLI_QUALITY)
+    with open(source_path, 'rb') as source, open(target_path, 'wb') as target:
+        for chunk in iter(lambda: source.read(FILE_CHUNK_SIZE), b""):
+            target.write(compressor.process(chunk))
+        target.write(compressor.finish())
+
+
+def parse_quality_values(header: Optional[str]) -> Dict[str, float]:
+    # Parses Accept / Accept-Encoding style headers, e.g. "gzip;q=0.8, br"
+    values = {}
+    for part in (header or '').split(','):
+        value, *params = [item.strip() for item in part.split(';')]
+        if not value:
+            continue
+        quality = 1.0
+        for param in params:
+            if param.startswith('q='):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        values[value.lower()] = quality
+    return values
+
+
+def parse_accept_encoding(accept_encoding: Optional[str]) -> Dict[str, float]:
+    return {'identity': 1.0, **parse_quality_values(accept_encoding)}
+
+
+def matches_etag(if_none_match: Optional[str], etag: str) -> bool:
+    # If-None-Match uses the weak comparison, so a "W/" prefix is ignored
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip().removeprefix('W/') for candidate in if_none_match.split(',')]
+    return '*' in candidates or etag in candidates
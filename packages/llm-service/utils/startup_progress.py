@@ -0,0 +1,61 @@
+import logging
+import threading
+import time
+from typing import List, Optional, Tuple
+
+# Progress of the (background) initialization of the service: the current phase and the duration of each finished
+# phase. Phases are started one after another, starting a phase finishes the previous one.
+
+logger = logging.getLogger(__name__)
+
+
+class StartupProgress:
+    def __init__(self):
+        self.start_time = time.time()
+        self.phase: Optional[str] = None
+        self.phase_start_time: Optional[float] = None
+        self.finished_phases: List[Tuple[str, float]] = []
+        self.ready = False
+        self.error: Optional[str] = None
+        self.lock = threading.Lock()
+
+    def end_phase(self):
+        if self.phase is not None:
+            self.finished_phases.append((self.phase, time.time() - self.phase_start_time))
+            self.phase = None
+
+    def start_phase(self, phase: str):
+        with self.lock:
+            self.end_phase()
+            self.phase = phase
+            self.phase_start_time = time.time()
+        logger.info(f"Startup: {phase} ...")
+
+    def finish(self):
+        with self.lock:
+            self.end_phase()
+            self.ready = True
+        logger.info(f"Startup finished in {time.time() - self.start_time:.1f} seconds:")
+        for phase, seconds in self.finished_phases:
+            logger.info(f"  -> {phase}: {seconds:.1f} seconds")
+
+    def fail(self, error: Exception):
+        with self.lock:
+            self.error = f"{self.phase or 'Startup'} failed: {error}"
+            self.end_phase()
+        logger.error(self.error)
+
+    def status(self) -> dict:
+        with self.lock:
+            return {
+                'ready': self.ready,
+                'phase': self.phase,
+                'phase_seconds': time.time() - self.phase_start_time if self.phase is not None else None,
+                'elapsed_seconds': time.time() - self.start_time,
+                'finished_phases': [{'phase': phase, 'seconds': seconds} for phase, seconds in self.finished_phases],
+                'error': self.error,
+            }
+
+
+# Shared by the initialization (reporting the phases) and the server (health & readiness endpoints)
+startup_progress = StartupProgress()